@@ -1,33 +1,166 @@
-import speech_recognition as sr
-import pywhatkit as kit
 from dotenv import load_dotenv
 import os
 import webbrowser
-import winsound
 import datetime
 import time
-import pygame
-import io
 import re
 import random
 import requests
-from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-from comtypes import CLSCTX_ALL
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pvporcupine
 import pyaudio
 import numpy as np
-from pydub import AudioSegment
 import threading
-import undetected_chromedriver as uc
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+import heapq
+import queue
+import subprocess
+import importlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import json
+import hashlib
+import atexit
+from collections import OrderedDict, deque
+import sqlite3
+import bisect
 
 
 API_USAGE_FILE = "api_usage.json"
+API_USAGE_EVENTS_FILE = "api_usage_events.jsonl"
+API_USAGE_FLUSH_INTERVAL = 5
+TRACE_FILE = "traces.jsonl"
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_BACKUPS = 3
+# Stages of a voice turn, in the order "api time" reports them.
+TRACE_STAGES = ["wake", "capture", "recognition", "intent", "dispatch", "gemini", "gemini_first_token",
+                "spotify", "youtube", "tts_first_byte", "audio_start", "playback", "turn"]
+CONVERSATION_FILE = "conversation.json"
+REMINDERS_FILE = "reminders.json"
+# Speech is requested as raw 16-bit mono PCM ("pcm_<rate>") and written straight to the output device.
+# An "mp3_<rate>_<bitrate>" format is decoded through ffmpeg instead, and is the fallback when a
+# provider refuses the PCM format.
+TTS_OUTPUT_FORMATS = {"elevenlabs": os.getenv('ELEVENLABS_OUTPUT_FORMAT', "pcm_24000")}
+TTS_FALLBACK_FORMAT = "mp3_44100_128"
+TTS_SAMPLE_RATE = int(TTS_OUTPUT_FORMATS["elevenlabs"].split("_")[1])
+TTS_OUTPUT_FRAMES = 1024
+CAPTURE_SAMPLE_RATE = 16000
+CAPTURE_FRAME_LENGTH = 512
+CAPTURE_BUFFER_SECONDS = 30
+# Voice activity detection: a frame is speech when its RMS energy exceeds the tracked noise floor
+# by VAD_SPEECH_RATIO. The utterance ends after a hangover of silence that grows with its length.
+VAD_SPEECH_RATIO = 3.0
+VAD_MIN_ENERGY = 300
+VAD_START_FRAMES = 3
+VAD_PREROLL_SECONDS = 0.3
+VAD_HANGOVER_SECONDS = 0.5
+VAD_HANGOVER_GROWTH = 0.1
+VAD_MAX_HANGOVER_SECONDS = 1.0
+VAD_TRAILING_SECONDS = 0.15
+# Barge-in: the wake word stays live while the assistant talks. During playback a detection only counts
+# when the microphone is BARGE_IN_ECHO_MARGIN times louder than the echo expected from the played audio.
+BARGE_IN_ECHO_MARGIN = 2.0
+BARGE_IN_WINDOW_SECONDS = 0.5
+PLAYBACK_REFERENCE_HOLD = 0.3
+WAKE_WORD_PATH = r"C:\Users\mangr\OneDrive\Desktop\Assistant\Hey-Grace_en_windows_v3_0_0.ppn"
+TTS_CHUNK_SIZE = 4096
+DEFAULT_VOICE_ID = "Xb7hH8MSUJpSbSDYk0k2"
+VOICE_SETTINGS = {"stability": 0.5, "clarity": 0.5, "similarity_boost": 0.75}
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MAX_BYTES = 50 * 1024 * 1024
+TTS_CACHE_MEMORY_ITEMS = 32
+TTS_CACHE_MAX_TEXT = 200
+# Long answers are spoken as a chain of chunks of at most TTS_CHUNK_MAX_CHARS (so each one fits the
+# speech cache). A chunk is synthesized once the chunk TTS_LOOKAHEAD_CHUNKS before it starts playing.
+TTS_CHUNK_MAX_CHARS = TTS_CACHE_MAX_TEXT
+TTS_LOOKAHEAD_CHUNKS = 2
+SPEECH_SYNTHESIS_WORKERS = 2
+# Keys with no known character quota are budgeted by synthesized audio seconds instead.
+VOICE_KEY_SECONDS_LIMIT = 600
+VOICE_CHARS_PER_SECOND = 15
+VOICE_KEY_COOLDOWNS = {"auth": 3600, "quota": 6 * 3600, "rate_limit": 30}
+# Lower values are spoken first; queued lines of equal priority keep their order.
+SPEECH_PRIORITY_REMINDER = 0
+SPEECH_PRIORITY_NORMAL = 10
+ELEVENLABS_API_URL = "https://api.elevenlabs.io"
+GEMINI_API_URL = "https://generativelanguage.googleapis.com"
+OPENWEATHER_API_URL = "http://api.openweathermap.org"
+YOUTUBE_URL = os.getenv('YOUTUBE_BASE_URL', "https://www.youtube.com")
+# (connect, read) timeouts in seconds per outbound service
+HTTP_TIMEOUTS = {
+    "elevenlabs": (3.05, 20),
+    "gemini": (3.05, 30),
+    "openweather": (3.05, 8),
+    "youtube": (3.05, 5),
+}
+HTTP_RETRIES = 2
+HTTP_POOL_SIZE = 4
+HTTP_WARM_ON_WAKE = True
+BROWSER_BINARY = os.getenv('BROWSER_BINARY', r"C:\Users\mangr\AppData\Local\BraveSoftware\Brave-Browser\Application\brave.exe")
+BROWSER_HEALTH_INTERVAL = 30
+YOUTUBE_CACHE_SIZE = 64
+WEATHER_LOCATION = os.getenv('WEATHER_LOCATION', "Pune")
+# Cached weather is served as-is within its TTL, and served while a background refresh runs for up to
+# WEATHER_MAX_STALE seconds. The prefetch interval stays under the TTL so the default location is always fresh.
+WEATHER_TTLS = {"weather": 600, "forecast": 1800}
+WEATHER_MAX_STALE = 3 * 3600
+WEATHER_PREFETCH_INTERVAL = 540
+# Installed in every page the browser opens, so playback controls never wait for the DOM to be searched.
+YOUTUBE_CONTROL_SCRIPT = """
+window.__graceControl = {
+    toggle: function() {
+        var video = document.querySelector('video');
+        if (!video) { return null; }
+        if (video.paused) { video.play(); } else { video.pause(); }
+        return video.paused;
+    },
+    next: function() {
+        var button = document.querySelector('a.ytp-next-button, .ytp-next-button');
+        if (!button) { return false; }
+        button.click();
+        return true;
+    }
+};
+"""
+GEMINI_MODEL = "gemini-1.5-flash"
+GEMINI_STREAMING = True
+CONVERSATION_KEEP_TURNS = 6
+CONVERSATION_TOKEN_BUDGET = 2000
+CONVERSATION_SUMMARY_WORDS = 150
+# Answers to self-contained questions are reused for ANSWER_CACHE_TTL seconds. Questions are keyed by
+# their words minus ANSWER_STOPWORDS; ones that refer back to the conversation always go to Gemini.
+ANSWER_CACHE_FILE = "answer_cache.json"
+ANSWER_CACHE_TTL = 24 * 3600
+ANSWER_CACHE_SIZE = 200
+ANSWER_STOPWORDS = {"a", "an", "the", "is", "are", "was", "were", "be", "of", "to", "in", "on", "for", "and",
+                    "or", "do", "does", "did", "me", "please", "about", "what", "whats", "what's", "who", "whos",
+                    "who's", "can", "could", "you", "tell", "search", "explain", "describe", "some", "any"}
+ANSWER_CONTEXT_WORDS = {"it", "its", "it's", "that", "this", "these", "those", "he", "him", "his", "she", "her",
+                        "they", "them", "their", "there", "again", "more", "else", "above", "previous", "last",
+                        "today", "tonight", "tomorrow", "yesterday", "now", "current", "latest", "news"}
+NUMBER_WORDS = {
+    "zero": 0, "ten": 10, "twenty": 20, "thirty": 30,
+    "forty": 40, "fifty": 50, "sixty": 60, "seventy": 70,
+    "eighty": 80, "ninety": 90, "hundred": 100
+}
+SITES = {
+    "youtube on chrome": "https://www.youtube.com",
+    "wikipedia": "https://www.wikipedia.com",
+    "google": "https://www.google.com"
+}
+RECOGNIZER_BACKEND = os.getenv('RECOGNIZER_BACKEND', "google")
+RECOGNIZER_LANGUAGE = "en-in"
+# Short control commands run as soon as the partial hypothesis has named them unchanged for
+# EARLY_COMMIT_STABLE_SECONDS, without waiting for the endpoint and the final hypothesis.
+EARLY_COMMIT_INTENTS = {"next_track", "previous_track", "spotify_play_pause", "youtube_play_pause", "the_time", "volume"}
+EARLY_COMMIT_MAX_WORDS = 4
+EARLY_COMMIT_STABLE_SECONDS = 0.25
+# A volume level can still grow ("twenty" -> "twenty five"), so it only commits early when spoken as
+# digits and after a longer pause in the partials.
+EARLY_COMMIT_LEVEL_STABLE_SECONDS = 0.6
+# A sentence ends at terminal punctuation followed by whitespace, or at a blank line.
+SENTENCE_BOUNDARY = re.compile(r'[.!?]+["\')\]]*\s+|\n\s*\n')
+CLAUSE_BOUNDARY = re.compile(r'(?<=[,;:])\s+|\s+(?=[—–(])')
 
 # Load environment variables
 load_dotenv()
@@ -35,159 +168,1258 @@ API_KEY = os.getenv('GEMINI_API_KEY')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 #LEOPARD_ACCESS_KEY = os.getenv('LEOPARD_ACCESS_KEY')
 
-VOICE_KEYS = [
+TTS_PREWARM_PHRASES = [
+    "uh huh...", "Ok.", "Ok", "Done.", "No active Spotify.", "I didn't catch that",
+    "I didn't catch that, say Grace to wake me up.", "Ok, call if you need any help.",
+    "next track on Spotify.", "next YouTube video.", "Couldn't skip track.",
+    "Please specify a valid time.", "Please specify what to play.", "Make sure Spotify is active."
+]
+if os.getenv('TTS_PREWARM_PHRASES'):
+    TTS_PREWARM_PHRASES = [phrase.strip() for phrase in os.getenv('TTS_PREWARM_PHRASES').split("|") if phrase.strip()]
+
+VOICE_KEYS = [key for key in [
     os.getenv('VOICE_API_KEY_1'),
     os.getenv('VOICE_API_KEY_2'),
     os.getenv('VOICE_API_KEY_3')
+] if key]
+
+# Seconds before a cached Spotify resource is refreshed in the background. Entries older than
+# SPOTIFY_CACHE_MAX_STALE times their TTL are refetched before use.
+SPOTIFY_CACHE_TTLS = {"playback": 10, "devices": 60, "playlists": 600, "genre_seeds": 86400}
+SPOTIFY_CACHE_MAX_STALE = 6
+# "Nothing playing" and "no devices" are never served from the cache; Spotify may have been opened since.
+SPOTIFY_CACHE_REFETCH_EMPTY = {"playback", "devices"}
+SPOTIFY_LIBRARY_DB = "spotify_library.db"
+SPOTIFY_LIBRARY_SYNC_INTERVAL = 1800
+# A library entry is used instead of a remote search when its match score reaches this value.
+SPOTIFY_LIBRARY_MATCH_THRESHOLD = 0.75
+# A track must also cover nearly all words of the query and of its title; "love" alone should not
+# play "Love Story" without asking Spotify's search.
+SPOTIFY_LIBRARY_TRACK_COVERAGE = 0.85
+SPOTIFY_LIBRARY_CANDIDATE_LIMIT = 200
+SPOTIFY_PLAYBACK_URI_LIMIT = 500
+# Background Spotify calls draw from a token bucket refilled at SPOTIFY_RATE_LIMIT calls per second.
+SPOTIFY_RATE_LIMIT = 4
+SPOTIFY_RATE_BURST = 8
+SPOTIFY_RATE_RETRIES = 3
+SPOTIFY_QUEUE_SIZE = 20
+SPOTIFY_QUEUE_START_DELAY = 2
+SPOTIFY_HISTORY_SIZE = 200
+
+SPOTIFY_SCOPE = ("user-library-read user-modify-playback-state user-read-playback-state "
+                 "playlist-read-private playlist-read-collaborative")
+# Integrations imported by the background warm-up once the wake-word loop is listening. Each is
+# otherwise loaded on first use, and a missing one only disables the commands that need it.
+LAZY_MODULES = [
+    "speech_recognition", "pydub", "spotipy", "spotipy.oauth2", "undetected_chromedriver",
+    "selenium.webdriver.common.by", "selenium.webdriver.support.ui", "selenium.webdriver.support.expected_conditions",
+    "pycaw.pycaw", "comtypes", "winsound",
 ]
 
-SPOTIFY_SCOPE = "user-library-read user-modify-playback-state user-read-playback-state"
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=os.getenv('SPOTIFY_CLIENT_ID'),
-    client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
-    redirect_uri=os.getenv('SPOTIFY_REDIRECT_URI'),
-    scope=SPOTIFY_SCOPE
-))
-
 # Global variables
+loaded_modules = {}
+sp = None
+spotify_client_lock = threading.Lock()
+wake_loop_ready = threading.Event()
+wake_queue = queue.Queue()
+wake_thread = None
+wake_lock = threading.Lock()
+# Number of takeCommand captures in progress; more than one turn can be listening at a time.
+command_captures = 0
+command_capture_lock = threading.Lock()
+turn_context = threading.local()
+active_turns = set()
+turn_lock = threading.Lock()
+playback_energy = 0.0
+playback_time = 0.0
+echo_gain = 1.0
 usage_tracker = {key: 0 for key in VOICE_KEYS}
-current_key_index = 0
-pygame.mixer.init()
+voice_key_state = {key: {"remaining": None, "cooldown_until": 0, "reason": None} for key in VOICE_KEYS}
 driver = None
+driver_lock = threading.Lock()
+browser_relaunch_allowed = True
+youtube_cache = OrderedDict()
+youtube_cache_lock = threading.Lock()
+weather_cache = {}
+weather_cache_lock = threading.Lock()
+weather_refreshing = set()
 conversation_history = []
+conversation_summary = ""
+conversation_lock = threading.Lock()
+summary_lock = threading.Lock()
+conversation_generation = 0
+answer_cache = OrderedDict()
+answer_cache_lock = threading.Lock()
+answer_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0}
+answer_cache_dirty = False
+intent_registry = []
+intent_matcher = None
+intent_groups = {}
 reminders = []
+reminder_condition = threading.Condition()
 reminder_thread_running = False
+next_reminder_id = 0
 api_usage_stats = {"voice_api": 0, "gemini_api": 0}
-playback_history = []
+api_call_counts = {"voice_api": 0, "gemini_api": 0}
+daily_usage = {}
+usage_lock = threading.Lock()
+usage_flush_event = threading.Event()
+usage_pending_events = []
+trace_queue = queue.Queue()
+trace_writer = None
+trace_lock = threading.Lock()
+current_turn = None
+current_turn_start = None
+playback_history = deque(maxlen=SPOTIFY_HISTORY_SIZE)
+spotify_queued_uris = deque(maxlen=SPOTIFY_HISTORY_SIZE)
+spotify_queue_lock = threading.Lock()
+spotify_queue_generation = 0
+spotify_queue_progress = {"queued": 0, "total": 0, "state": "idle"}
+spotify_jobs = queue.Queue()
+spotify_job_worker = None
+audio_interface = None
+output_stream = None
+tts_formats = dict(TTS_OUTPUT_FORMATS)
+capture_lock = threading.Lock()
+capture_ring = None
+capture_thread = None
+capture_running = False
+command_cursor = None
+porcupine_handle = None
+recognizer_backend = None
+noise_floor = VAD_MIN_ENERGY / VAD_SPEECH_RATIO
+noise_thread = None
+tts_cache_lock = threading.Lock()
+tts_cache_index = None
+tts_cache_memory = OrderedDict()
+http_sessions = {}
+speech_queue = queue.PriorityQueue()
+speech_pool = ThreadPoolExecutor(max_workers=SPEECH_SYNTHESIS_WORKERS, thread_name_prefix="speech")
+speech_lock = threading.Lock()
+speech_sequence = 0
+speech_worker = None
+current_utterance = None
+spotify_cache = {}
+spotify_cache_lock = threading.Lock()
+spotify_refreshing = set()
+spotify_library_db = None
+spotify_library_lock = threading.Lock()
+library_tracks = None
+library_playlists = None
+http_sessions_lock = threading.Lock()
 
 # Helper Functions
 
-def play_audio(audio_stream):
-    pygame.mixer.music.load(audio_stream, "mp3")
-    pygame.mixer.music.play()
-    while pygame.mixer.music.get_busy():
-        pygame.time.Clock().tick(10)
+def load_module(name):
+    # Imports an optional integration on first use; a missing one is reported once and yields None.
+    if name not in loaded_modules:
+        try:
+            loaded_modules[name] = importlib.import_module(name)
+        except Exception as e:
+            print(f"{name} is unavailable: {e}")
+            loaded_modules[name] = None
+    return loaded_modules[name]
+
+def require_module(name):
+    module = load_module(name)
+    if module is None:
+        raise RuntimeError(f"{name} is not installed")
+    return module
+
+def warm_integrations():
+    for name in LAZY_MODULES:
+        load_module(name)
+
+def get_ffmpeg_path():
+    pydub = load_module("pydub")
+    return pydub.AudioSegment.converter if pydub else "ffmpeg"
+
+def get_audio_interface():
+    global audio_interface
+    if audio_interface is None:
+        audio_interface = pyaudio.PyAudio()
+    return audio_interface
+
+def get_output_stream():
+    # One output stream stays open for the whole process; only the playback worker writes to it.
+    global output_stream
+    if output_stream is None:
+        output_stream = get_audio_interface().open(format=pyaudio.paInt16, channels=1, rate=TTS_SAMPLE_RATE,
+                                                   output=True, frames_per_buffer=TTS_OUTPUT_FRAMES)
+    return output_stream
+
+def note_playback(pcm):
+    # The level of what is being played is the reference for telling echo from a barge-in.
+    global playback_energy, playback_time
+    energy = frame_energy(np.frombuffer(pcm, dtype=np.int16))
+    recent = time.time() - playback_time < PLAYBACK_REFERENCE_HOLD
+    playback_energy = playback_energy * 0.8 + energy * 0.2 if recent else energy
+    playback_time = time.time()
+
+def play_audio(pcm_chunks, sample_rate=TTS_SAMPLE_RATE, cancelled=None):
+    # Writes 16-bit mono PCM as it arrives and returns the played duration in seconds. Chunks are
+    # written a device buffer at a time so a cancelled line stops within a few milliseconds.
+    global output_stream
+    stream = get_output_stream()
+    played_bytes = 0
+    step = TTS_OUTPUT_FRAMES * 2
+    try:
+        for pcm in pcm_chunks:
+            view = memoryview(pcm)
+            for offset in range(0, len(view), step):
+                if cancelled is not None and cancelled.is_set():
+                    return played_bytes / (sample_rate * 2)
+                buffer = view[offset:offset + step]
+                note_playback(buffer)
+                stream.write(buffer)
+                played_bytes += len(buffer)
+    except OSError:
+        # The device went away; the next line reopens it.
+        output_stream = None
+        stream.close()
+        raise
+    return played_bytes / (sample_rate * 2)
+
+def align_pcm_stream(chunks):
+    # Network chunks can split a 16-bit sample. Chunks are passed on as memoryview slices, so only
+    # the two bytes of a split sample are ever copied.
+    carry = b""
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if carry and view:
+            yield carry + view[:1].tobytes()
+            view = view[1:]
+            carry = b""
+        if len(view) % 2:
+            carry = view[-1:].tobytes()
+            view = view[:-1]
+        if view:
+            yield view
+
+def iter_speech_pcm(response):
+    chunks = response.iter_content(chunk_size=TTS_CHUNK_SIZE)
+    if "mpeg" in response.headers.get("Content-Type", "") or response.output_format.startswith("mp3"):
+        return decode_mp3_stream(chunks)
+    return align_pcm_stream(chunks)
+
+def decode_mp3_stream(mp3_chunks, sample_rate=TTS_SAMPLE_RATE):
+    # Pipes MP3 chunks through ffmpeg and yields PCM while the rest is still downloading.
+    decoder = subprocess.Popen(
+        [get_ffmpeg_path(), "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+         "-f", "s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+
+    def feed_decoder():
+        try:
+            for chunk in mp3_chunks:
+                if chunk:
+                    decoder.stdin.write(chunk)
+        except Exception as e:
+            print(f"Error streaming audio: {e}")
+        finally:
+            try:
+                decoder.stdin.close()
+            except Exception:
+                pass
+
+    threading.Thread(target=feed_decoder, daemon=True).start()
+    try:
+        while True:
+            pcm = decoder.stdout.read(TTS_CHUNK_SIZE)
+            if not pcm:
+                break
+            yield pcm
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+
+def get_http_session(service):
+    with http_sessions_lock:
+        session = http_sessions.get(service)
+        if session is None:
+            # Connection failures are retried for every method; read and status
+            # failures only for idempotent ones, so a POST is never sent twice.
+            retry = Retry(
+                total=HTTP_RETRIES, connect=HTTP_RETRIES, read=HTTP_RETRIES, status=HTTP_RETRIES,
+                backoff_factor=0.3, status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]), raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_sessions[service] = session
+        return session
+
+def http_request(service, method, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_TIMEOUTS[service])
+    return get_http_session(service).request(method, url, **kwargs)
+
+def warm_http_connections():
+    for service, base_url in [("elevenlabs", ELEVENLABS_API_URL), ("gemini", GEMINI_API_URL),
+                              ("openweather", OPENWEATHER_API_URL), ("youtube", YOUTUBE_URL)]:
+        try:
+            http_request(service, "HEAD", base_url).close()
+        except Exception as e:
+            print(f"Error warming {service} connection: {e}")
+
+def tts_cache_key(text, voice_id, voice_settings=VOICE_SETTINGS):
+    key_data = json.dumps({"voice_id": voice_id, "text": text, "voice_settings": voice_settings,
+                           "sample_rate": TTS_SAMPLE_RATE}, sort_keys=True)
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+def load_tts_cache_index():
+    # Least recently used entries come first, ordered by file mtime.
+    global tts_cache_index
+    if tts_cache_index is None:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        entries = []
+        for name in os.listdir(TTS_CACHE_DIR):
+            if name.endswith(".pcm"):
+                stat = os.stat(os.path.join(TTS_CACHE_DIR, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        tts_cache_index = OrderedDict((key, size) for _, key, size in sorted(entries))
+    return tts_cache_index
+
+def get_cached_speech(text, voice_id=DEFAULT_VOICE_ID):
+    key = tts_cache_key(text, voice_id)
+    with tts_cache_lock:
+        if key in tts_cache_memory:
+            tts_cache_memory.move_to_end(key)
+            load_tts_cache_index().move_to_end(key)
+            return tts_cache_memory[key]
+        index = load_tts_cache_index()
+        if key not in index:
+            return None
+        path = os.path.join(TTS_CACHE_DIR, f"{key}.pcm")
+        try:
+            with open(path, "rb") as file:
+                pcm = file.read()
+            os.utime(path)
+        except OSError:
+            index.pop(key, None)
+            return None
+        index.move_to_end(key)
+        remember_speech(key, pcm)
+        return pcm
+
+def remember_speech(key, pcm):
+    tts_cache_memory[key] = pcm
+    tts_cache_memory.move_to_end(key)
+    while len(tts_cache_memory) > TTS_CACHE_MEMORY_ITEMS:
+        tts_cache_memory.popitem(last=False)
+
+def store_cached_speech(text, voice_id, pcm):
+    if not pcm or len(text) > TTS_CACHE_MAX_TEXT:
+        return
+    key = tts_cache_key(text, voice_id)
+    with tts_cache_lock:
+        index = load_tts_cache_index()
+        path = os.path.join(TTS_CACHE_DIR, f"{key}.pcm")
+        try:
+            with open(path + ".tmp", "wb") as file:
+                file.write(pcm)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Error caching speech: {e}")
+            return
+        index[key] = len(pcm)
+        index.move_to_end(key)
+        remember_speech(key, pcm)
+        total_bytes = sum(index.values())
+        while total_bytes > TTS_CACHE_MAX_BYTES and len(index) > 1:
+            old_key, old_size = index.popitem(last=False)
+            tts_cache_memory.pop(old_key, None)
+            try:
+                os.remove(os.path.join(TTS_CACHE_DIR, f"{old_key}.pcm"))
+            except OSError:
+                pass
+            total_bytes -= old_size
+
+def key_fingerprint(key):
+    # Keys are persisted by fingerprint so secrets never reach the usage files.
+    if not key:
+        return "missing"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:10]
 
 def load_api_usage():
+    global api_usage_stats, api_call_counts, daily_usage
+    data = {}
     if os.path.exists(API_USAGE_FILE):
-        with open(API_USAGE_FILE, "r") as file:
-            data = json.load(file)
-            return data.get("api_usage", {"voice_api": 0, "gemini_api": 0}), data.get("current_key_index", 0)
-    return {"voice_api": 0, "gemini_api": 0}, 0 
+        try:
+            with open(API_USAGE_FILE, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Error reading {API_USAGE_FILE}, starting with empty usage: {e}")
+            try:
+                os.replace(API_USAGE_FILE, API_USAGE_FILE + ".corrupt")
+            except OSError:
+                pass
+    api_usage_stats = {"voice_api": 0, "gemini_api": 0, **data.get("api_usage", {})}
+    api_call_counts = {"voice_api": 0, "gemini_api": 0, **data.get("api_calls", {})}
+    daily_usage = data.get("daily_usage", {})
+    key_usage = data.get("key_usage", {})
+    key_state = data.get("key_state", {})
+    for key in VOICE_KEYS:
+        usage_tracker[key] = key_usage.get(key_fingerprint(key), 0)
+        voice_key_state[key].update(key_state.get(key_fingerprint(key), {}))
 
 def save_api_usage():
-    with open(API_USAGE_FILE, "w") as file:
-        json.dump({"api_usage": api_usage_stats, "current_key_index": current_key_index}, file)
-
-api_usage_stats, current_key_index = load_api_usage()
-
-def log_api_usage(api_name, duration=0):
-    global api_usage_stats 
-    if api_name in api_usage_stats:
+    # Atomically rewrites the aggregates and appends buffered events to the JSONL log.
+    with usage_lock:
+        usage_flush_event.clear()
+        snapshot = json.dumps({
+            "api_usage": api_usage_stats,
+            "api_calls": api_call_counts,
+            "key_usage": {key_fingerprint(key): seconds for key, seconds in usage_tracker.items()},
+            "key_state": {key_fingerprint(key): state for key, state in voice_key_state.items()},
+            "daily_usage": daily_usage,
+        })
+        events = usage_pending_events[:]
+        del usage_pending_events[:]
+    try:
+        with open(API_USAGE_FILE + ".tmp", "w") as file:
+            file.write(snapshot)
+        os.replace(API_USAGE_FILE + ".tmp", API_USAGE_FILE)
+        if events:
+            with open(API_USAGE_EVENTS_FILE, "a") as file:
+                file.writelines(json.dumps(event) + "\n" for event in events)
+    except OSError as e:
+        print(f"Error saving API usage: {e}")
+
+def flush_api_usage_loop():
+    # Batches writes: the first change after a flush starts a new interval.
+    while True:
+        usage_flush_event.wait()
+        time.sleep(API_USAGE_FLUSH_INTERVAL)
+        save_api_usage()
+
+def flush_api_usage_on_exit():
+    if usage_flush_event.is_set():
+        save_api_usage()
+
+load_api_usage()
+atexit.register(flush_api_usage_on_exit)
+
+def log_api_usage(api_name, duration=0, key=None):
+    if api_name not in api_usage_stats:
+        return
+    now = time.time()
+    day = datetime.date.fromtimestamp(now).isoformat()
+    with usage_lock:
         api_usage_stats[api_name] += duration
-        save_api_usage()  
+        api_call_counts[api_name] = api_call_counts.get(api_name, 0) + 1
+        day_stats = daily_usage.setdefault(day, {})
+        day_stats[api_name] = day_stats.get(api_name, 0) + duration
+        day_stats[f"{api_name}_calls"] = day_stats.get(f"{api_name}_calls", 0) + 1
+        event = {"ts": round(now, 3), "api": api_name, "duration": round(duration, 3)}
+        if key is not None:
+            usage_tracker[key] = usage_tracker.get(key, 0) + duration
+            event["key"] = key_fingerprint(key)
+        usage_pending_events.append(event)
+        usage_flush_event.set()
+
+def get_usage_totals():
+    with usage_lock:
+        return {api: {"seconds": seconds, "calls": api_call_counts.get(api, 0)} for api, seconds in api_usage_stats.items()}
+
+def get_daily_usage(days=7):
+    with usage_lock:
+        return [(day, dict(daily_usage[day])) for day in sorted(daily_usage)[-days:]]
+
+def get_key_usage():
+    with usage_lock:
+        return [(f"key {index + 1}", usage_tracker.get(key, 0)) for index, key in enumerate(VOICE_KEYS)]
+
+def get_voice_key_status():
+    now = time.time()
+    with usage_lock:
+        return [(f"key {index + 1}", voice_key_headroom(key),
+                 voice_key_state[key]["reason"] if voice_key_state[key]["cooldown_until"] > now else None)
+                for index, key in enumerate(VOICE_KEYS)]
+
+def read_usage_events(api_name=None, since=None):
+    events = []
+    if os.path.exists(API_USAGE_EVENTS_FILE):
+        with open(API_USAGE_EVENTS_FILE, "r") as file:
+            for line in file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    with usage_lock:
+        events.extend(usage_pending_events)
+    return [event for event in events
+            if (api_name is None or event["api"] == api_name) and (since is None or event["ts"] >= since)]
 
 def show_api_usage():
     stats_text = "API Usage Stats:\n"
-    for api, usage in api_usage_stats.items():
-        stats_text += f"{api}: {usage:.2f} seconds\n"
-    print(stats_text) 
+    for api, usage in get_usage_totals().items():
+        stats_text += f"{api}: {usage['seconds']:.2f} seconds over {usage['calls']} calls\n"
+    for (label, seconds), (_, headroom, cooling) in zip(get_key_usage(), get_voice_key_status()):
+        stats_text += f"voice {label}: {seconds:.2f} seconds, about {max(headroom, 0):.0f} characters left"
+        stats_text += f", cooling down after {cooling}\n" if cooling else "\n"
+    for day, day_stats in get_daily_usage():
+        stats_text += f"{day}: voice {day_stats.get('voice_api', 0):.2f} seconds, gemini {day_stats.get('gemini_api_calls', 0)} calls\n"
+    cache = get_answer_cache_stats()
+    stats_text += (f"answer cache: {cache['entries']} entries, {cache['hits']} hits, {cache['misses']} misses, "
+                   f"{cache['bypassed']} bypassed\n")
+    queue = get_spotify_queue_progress()
+    if queue["state"] != "idle":
+        stats_text += f"spotify queue: {queue['queued']} of {queue['total']} tracks queued, {queue['state']}\n"
+    for stage, count, p50, p95, p99 in get_stage_latencies():
+        stats_text += f"{stage}: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms over {count} spans\n"
+    print(stats_text)
     with open("api_usage.log", "w") as log_file:
         log_file.write(stats_text)
 
-def switch_api_key():
-    global current_key_index
-    current_key_index = (current_key_index + 1) % len(VOICE_KEYS)
-    save_api_usage()
-    return VOICE_KEYS[current_key_index]
+# Latency Tracing
+
+def start_turn(started=None):
+    global current_turn, current_turn_start
+    current_turn_start = started or time.time()
+    current_turn = f"{int(current_turn_start * 1000):x}"
+    return current_turn
+
+def record_span(stage, start, end=None, turn=None, **attrs):
+    # Spans are queued for the writer thread so tracing never does file I/O on the voice path.
+    global trace_writer
+    end = time.time() if end is None else end
+    span = {"turn": turn or current_turn, "stage": stage, "start": round(start, 3), "ms": round((end - start) * 1000, 1)}
+    span.update(attrs)
+    with trace_lock:
+        if trace_writer is None or not trace_writer.is_alive():
+            trace_writer = threading.Thread(target=write_traces, daemon=True)
+            trace_writer.start()
+    trace_queue.put(span)
+
+def traced(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_span(stage, start, function=function.__name__)
+        return wrapper
+    return decorator
+
+def rotate_traces():
+    for index in range(TRACE_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{TRACE_FILE}.{index}"):
+            os.replace(f"{TRACE_FILE}.{index}", f"{TRACE_FILE}.{index + 1}")
+    os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+
+def write_traces():
+    while True:
+        spans = [trace_queue.get()]
+        while True:
+            try:
+                spans.append(trace_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) >= TRACE_MAX_BYTES:
+                rotate_traces()
+            with open(TRACE_FILE, "a") as file:
+                file.writelines(json.dumps(span) + "\n" for span in spans)
+        except OSError as e:
+            print(f"Error writing traces: {e}")
+
+def read_traces():
+    spans = []
+    for path in [f"{TRACE_FILE}.{index}" for index in range(TRACE_BACKUPS, 0, -1)] + [TRACE_FILE]:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r") as file:
+            for line in file:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    return spans
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def get_stage_latencies():
+    durations = {}
+    for span in read_traces():
+        durations.setdefault(span["stage"], []).append(span["ms"])
+    stages = TRACE_STAGES + sorted(set(durations) - set(TRACE_STAGES))
+    return [(stage, len(durations[stage]), percentile(durations[stage], 0.5), percentile(durations[stage], 0.95),
+             percentile(durations[stage], 0.99)) for stage in stages if stage in durations]
+
+# Voice Key Pool
+
+def voice_key_label(key):
+    return f"key {VOICE_KEYS.index(key) + 1}"
+
+def voice_key_headroom(key):
+    # Characters the key can still synthesize; callers hold usage_lock.
+    remaining = voice_key_state[key]["remaining"]
+    if remaining is not None:
+        return remaining
+    return (VOICE_KEY_SECONDS_LIMIT - usage_tracker.get(key, 0)) * VOICE_CHARS_PER_SECOND
+
+def pick_voice_key(exclude=()):
+    now = time.time()
+    with usage_lock:
+        candidates = [(voice_key_headroom(key), key) for key in VOICE_KEYS
+                      if key not in exclude and voice_key_state[key]["cooldown_until"] <= now]
+    # An estimate at or below zero still beats no voice; the server has the final word on quota.
+    return max(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+def cool_down_voice_key(key, reason, seconds=None):
+    seconds = seconds or VOICE_KEY_COOLDOWNS[reason]
+    with usage_lock:
+        voice_key_state[key].update(cooldown_until=time.time() + seconds, reason=reason)
+        usage_flush_event.set()
+    print(f"Voice {voice_key_label(key)} failed ({reason}), skipping it for {seconds:.0f} seconds.")
+
+def classify_voice_error(response):
+    # Returns why the key itself was refused, or None when the failure has nothing to do with the key.
+    if response.status_code not in (401, 402, 429):
+        return None
+    try:
+        detail = response.json().get("detail", {})
+        status = detail.get("status", "") if isinstance(detail, dict) else ""
+    except ValueError:
+        status = ""
+    if status == "quota_exceeded" or response.status_code == 402:
+        return "quota"
+    return "rate_limit" if response.status_code == 429 else "auth"
+
+def note_voice_quota(key, response):
+    # ElevenLabs reports what each request cost; the subscription refresh resets the running figure.
+    cost = response.headers.get("character-cost")
+    if cost and cost.isdigit():
+        with usage_lock:
+            if voice_key_state[key]["remaining"] is not None:
+                voice_key_state[key]["remaining"] -= int(cost)
+            usage_flush_event.set()
+
+def refresh_voice_quotas():
+    for key in VOICE_KEYS:
+        try:
+            response = http_request("elevenlabs", "GET", f"{ELEVENLABS_API_URL}/v1/user/subscription",
+                                    headers={"xi-api-key": key})
+            if response.status_code != 200:
+                reason = classify_voice_error(response)
+                if reason:
+                    cool_down_voice_key(key, reason)
+                continue
+            data = response.json()
+            remaining = data["character_limit"] - data["character_count"]
+            with usage_lock:
+                state = voice_key_state[key]
+                state["remaining"] = remaining
+                if state["reason"] == "quota" and remaining > 0:
+                    state.update(cooldown_until=0, reason=None)
+                usage_flush_event.set()
+        except Exception as e:
+            print(f"Error refreshing quota for voice {voice_key_label(key)}: {e}")
 
 def reset_conversation():
-    global conversation_history
-    conversation_history = []
+    global conversation_history, conversation_summary, conversation_generation
+    with conversation_lock:
+        conversation_history = []
+        conversation_summary = ""
+        # A summary fold still in flight belongs to the old conversation and is discarded.
+        conversation_generation += 1
+        save_conversation()
     say("Conversation history reset.")
 
+def load_reminders():
+    global reminders, next_reminder_id
+    if os.path.exists(REMINDERS_FILE):
+        try:
+            with open(REMINDERS_FILE, "r") as file:
+                data = json.load(file)
+            reminders = [(item["trigger_time"], item["id"], item["text"]) for item in data]
+            heapq.heapify(reminders)
+            next_reminder_id = max((item["id"] for item in data), default=-1) + 1
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading reminders: {e}")
+
+def save_reminders():
+    # Called with reminder_condition held.
+    try:
+        data = [{"id": reminder_id, "text": text, "trigger_time": trigger_time}
+                for trigger_time, reminder_id, text in sorted(reminders)]
+        with open(REMINDERS_FILE + ".tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(REMINDERS_FILE + ".tmp", REMINDERS_FILE)
+    except OSError as e:
+        print(f"Error saving reminders: {e}")
+
+load_reminders()
+
 def add_reminder(reminder_text, delay_minutes):
-    global reminders
+    global next_reminder_id
     trigger_time = time.time() + delay_minutes * 60
-    reminders.append((reminder_text, trigger_time))
+    with reminder_condition:
+        heapq.heappush(reminders, (trigger_time, next_reminder_id, reminder_text))
+        next_reminder_id += 1
+        save_reminders()
+        reminder_condition.notify()
     say(f"Reminder set for {delay_minutes} minutes from now.")
 
+def list_reminders():
+    with reminder_condition:
+        return [(text, trigger_time) for trigger_time, _, text in sorted(reminders)]
+
+def cancel_reminders(reminder_text=None):
+    # Cancels reminders whose text contains reminder_text, or the next due one when no text is given.
+    global reminders
+    with reminder_condition:
+        if reminder_text is None:
+            cancelled = [heapq.heappop(reminders)] if reminders else []
+        else:
+            cancelled = [item for item in reminders if reminder_text in item[2].lower()]
+            reminders = [item for item in reminders if item not in cancelled]
+            heapq.heapify(reminders)
+        if cancelled:
+            save_reminders()
+            reminder_condition.notify()
+    return len(cancelled)
+
+def cancel_all_reminders():
+    global reminders
+    with reminder_condition:
+        count = len(reminders)
+        reminders = []
+        save_reminders()
+        reminder_condition.notify()
+    return count
+
 def play_alarm_sound():
+    winsound = load_module("winsound")
     for _ in range(3):
-        winsound.Beep(1000, 700) 
+        if winsound:
+            winsound.Beep(1000, 700)
+        else:
+            print("\a", end="", flush=True)
         time.sleep(0.3)
 
 def check_reminders():
-    global reminders
+    # Sleeps until the earliest reminder is due; add/cancel notify the condition to re-evaluate.
+    global reminder_thread_running
     reminder_thread_running = True
-    while reminder_thread_running:
-        current_time = time.time()
-        for reminder in reminders[:]:
-            reminder_text, trigger_time = reminder
-            if current_time >= trigger_time:
-                play_alarm_sound()
-                say(f"Reminder: {reminder_text}")  
-                reminders.remove(reminder)  
-        time.sleep(1)
-
-def get_weather():
-    try:
-        city_name = "Pune" 
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city_name}&appid={WEATHER_API_KEY}&units=metric"
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            weather = data['weather'][0]['description']
-            temperature = data['main']['temp']
-            return f"The weather in Pune is {weather} with a temperature of {temperature}°C."
-        else:
-            return f"Error fetching weather: {response.status_code}"
+    while True:
+        with reminder_condition:
+            while reminder_thread_running and (not reminders or reminders[0][0] > time.time()):
+                timeout = reminders[0][0] - time.time() if reminders else None
+                reminder_condition.wait(timeout)
+            if not reminder_thread_running:
+                return
+            due = []
+            while reminders and reminders[0][0] <= time.time():
+                due.append(heapq.heappop(reminders))
+            save_reminders()
+        for _, _, reminder_text in due:
+            play_alarm_sound()
+            say(f"Reminder: {reminder_text}", priority=SPEECH_PRIORITY_REMINDER)
+
+def stop_reminders():
+    global reminder_thread_running
+    with reminder_condition:
+        reminder_thread_running = False
+        reminder_condition.notify()
+
+def fetch_weather(kind, location):
+    response = http_request("openweather", "GET", f"{OPENWEATHER_API_URL}/data/2.5/{kind}",
+                            params={"q": location, "appid": WEATHER_API_KEY, "units": "metric"})
+    response.raise_for_status()
+    data = response.json()
+    with weather_cache_lock:
+        weather_cache[(kind, location.lower())] = (data, time.time())
+    return data
+
+def refresh_weather_async(kind, location):
+    key = (kind, location.lower())
+    with weather_cache_lock:
+        if key in weather_refreshing:
+            return
+        weather_refreshing.add(key)
+
+    def refresh():
+        try:
+            fetch_weather(kind, location)
+        except Exception as e:
+            print(f"Error refreshing {kind} for {location}: {e}")
+        finally:
+            with weather_cache_lock:
+                weather_refreshing.discard(key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+def get_weather_data(kind, location=None):
+    # A recent answer is served while the upstream is refreshed in the background, so a slow or
+    # unreachable OpenWeather never holds up the voice turn.
+    location = location or WEATHER_LOCATION
+    with weather_cache_lock:
+        entry = weather_cache.get((kind, location.lower()))
+    if entry is not None:
+        data, fetched_at = entry
+        age = time.time() - fetched_at
+        if age <= WEATHER_TTLS[kind]:
+            return data
+        if age <= WEATHER_MAX_STALE:
+            refresh_weather_async(kind, location)
+            return data
+    return fetch_weather(kind, location)
+
+def prefetch_weather_loop():
+    while True:
+        for kind in WEATHER_TTLS:
+            try:
+                fetch_weather(kind, WEATHER_LOCATION)
+            except Exception as e:
+                print(f"Error prefetching {kind}: {e}")
+        time.sleep(WEATHER_PREFETCH_INTERVAL)
+
+def describe_forecast(data, when=None):
+    # Forecast entries are 3-hourly; the city's UTC offset decides which day each one falls on.
+    offset = datetime.timedelta(seconds=data['city'].get('timezone', 0))
+    local_now = datetime.datetime.utcnow() + offset
+    entries = [(datetime.datetime.utcfromtimestamp(entry['dt']) + offset, entry) for entry in data['list']]
+    if when == "tomorrow":
+        tomorrow = local_now.date() + datetime.timedelta(days=1)
+        selected = [entry for local_time, entry in entries if local_time.date() == tomorrow]
+    elif when == "tonight":
+        selected = [entry for local_time, entry in entries
+                    if local_time.date() == local_now.date() and local_time.hour >= 18]
+    else:
+        selected = [entry for local_time, entry in entries if local_time > local_now][:8]
+    if not selected:
+        selected = [entry for _, entry in entries][:8]
+    descriptions = [entry['weather'][0]['description'] for entry in selected]
+    outlook = max(set(descriptions), key=descriptions.count)
+    low = min(entry['main']['temp_min'] for entry in selected)
+    high = max(entry['main']['temp_max'] for entry in selected)
+    return f"{when.capitalize() if when else 'Over the next day'} in {data['city']['name']} expect {outlook}, between {low:.0f} and {high:.0f}°C."
+
+def get_weather(location=None, when=None):
+    location = location or WEATHER_LOCATION
+    try:
+        if when in ("tomorrow", "tonight", "later"):
+            return describe_forecast(get_weather_data("forecast", location), None if when == "later" else when)
+        data = get_weather_data("weather", location)
+        weather = data['weather'][0]['description']
+        temperature = data['main']['temp']
+        return f"The weather in {data.get('name', location)} is {weather} with a temperature of {temperature}°C."
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return f"I couldn't find the weather for {location}."
+        return f"Error fetching weather: {e.response.status_code if e.response is not None else e}"
     except Exception as e:
         return f"Error: {str(e)}"
 
 # Core Functions
-def say(text, voice_id="Xb7hH8MSUJpSbSDYk0k2"):
-    global usage_tracker, current_key_index
-    try:
-        current_key = VOICE_KEYS[current_key_index]
+def track_voice_usage(current_key, audio_duration):
+    log_api_usage("voice_api", audio_duration, key=current_key)
+
+def request_speech(text, voice_id=DEFAULT_VOICE_ID):
+    # Tries keys by headroom; a key refused for auth, quota or rate limits is cooled down and the
+    # same text goes to the next healthy key straight away.
+    payload = {"text": text, "voice_settings": VOICE_SETTINGS}
+    API_URL = f"{ELEVENLABS_API_URL}/v1/text-to-speech/{voice_id}/stream"
+    tried = set()
+    while True:
+        current_key = pick_voice_key(tried)
+        if current_key is None:
+            print("No voice API key is available.")
+            return None, None
+        tried.add(current_key)
         headers = {"xi-api-key": current_key, "Content-Type": "application/json"}
-        payload = {"text": text, "voice_settings": {"stability": 0.5, "clarity": 0.5, "similarity_boost": 0.75}}
-        API_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream"
-        response = requests.post(API_URL, headers=headers, json=payload, stream=True)
+        output_format = tts_formats["elevenlabs"]
+        response = http_request("elevenlabs", "POST", API_URL, headers=headers, json=payload,
+                                params={"output_format": output_format}, stream=True)
         if response.status_code == 200:
-            audio = AudioSegment.from_mp3(io.BytesIO(response.content))
-            audio_duration = len(audio) / 1000
-            log_api_usage("voice_api", audio_duration)
-            usage_tracker[current_key] += audio_duration
-            if usage_tracker[current_key] >= 600:
-                print(f"API key {current_key} has reached the 10-minute limit.")
-                switch_api_key()
-                print(f"Switched to API key: {VOICE_KEYS[current_key_index]}")
-            audio_stream = io.BytesIO(response.content)
-            audio_thread = threading.Thread(target=play_audio, args=(audio_stream,))
-            audio_thread.start()
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
+            note_voice_quota(current_key, response)
+            response.output_format = output_format
+            return response, current_key
+        if response.status_code in (400, 403) and output_format != TTS_FALLBACK_FORMAT:
+            # Raw PCM needs a plan that allows it; drop to MP3 for the rest of the session.
+            print(f"Voice output format {output_format} refused, falling back to {TTS_FALLBACK_FORMAT}.")
+            response.close()
+            tts_formats["elevenlabs"] = TTS_FALLBACK_FORMAT
+            tried.discard(current_key)
+            continue
+        reason = classify_voice_error(response)
+        retry_after = response.headers.get("Retry-After")
+        print(f"Error: {response.status_code} - {response.text}")
+        response.close()
+        if reason is None:
+            return None, current_key
+        cool_down_voice_key(current_key, reason,
+                            float(retry_after) if reason == "rate_limit" and retry_after and retry_after.isdigit() else None)
+
+class Utterance:
+    def __init__(self, text, voice_id, priority):
+        self.text = text
+        self.voice_id = voice_id
+        self.priority = priority
+        self.pcm_chunks = queue.Queue()
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.turn = current_turn
+        self.created = time.time()
+        self.started = None
+        self.followers = []
+        self.released = False
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def iter_pcm(self):
+        while not self.cancelled.is_set():
+            pcm = self.pcm_chunks.get()
+            if pcm is None:
+                return
+            yield pcm
+
+def synthesize_utterance(utterance):
+    # Runs on the synthesis pool; PCM is handed to the playback worker chunk by chunk.
+    try:
+        cached_pcm = get_cached_speech(utterance.text, utterance.voice_id)
+        if cached_pcm is not None:
+            record_span("tts_first_byte", utterance.created, turn=utterance.turn, cached=True)
+            utterance.pcm_chunks.put(cached_pcm)
+            return
+        if utterance.cancelled.is_set():
+            return
+        response, current_key = request_speech(utterance.text, utterance.voice_id)
+        if response is None:
+            return
+        # Chunks are only kept for lines short enough for the speech cache.
+        cacheable = len(utterance.text) <= TTS_CACHE_MAX_TEXT
+        pcm_chunks = []
+        pcm_bytes = 0
+        try:
+            for pcm in iter_speech_pcm(response):
+                if utterance.cancelled.is_set():
+                    break
+                if not pcm_bytes:
+                    record_span("tts_first_byte", utterance.created, turn=utterance.turn, cached=False)
+                pcm_bytes += len(pcm)
+                if cacheable:
+                    pcm_chunks.append(pcm)
+                utterance.pcm_chunks.put(pcm)
+        finally:
+            response.close()
+        track_voice_usage(current_key, pcm_bytes / (TTS_SAMPLE_RATE * 2))
+        if cacheable and not utterance.cancelled.is_set():
+            store_cached_speech(utterance.text, utterance.voice_id, b"".join(pcm_chunks))
     except Exception as e:
         print(f"Error in generating speech: {e}")
+    finally:
+        utterance.pcm_chunks.put(None)
+
+def trace_audio_start(utterance):
+    for pcm in utterance.iter_pcm():
+        if utterance.started is None:
+            utterance.started = time.time()
+            record_span("audio_start", utterance.created, utterance.started, turn=utterance.turn)
+        yield pcm
+
+def release_followers(utterance):
+    # Starts synthesis of the chunks that were waiting for this one to reach the speaker. Followers of
+    # a cancelled chunk are cancelled too, and still submitted so their playback ends at once.
+    with speech_lock:
+        utterance.released = True
+        followers = utterance.followers
+        utterance.followers = []
+    for follower in followers:
+        if utterance.cancelled.is_set():
+            follower.cancel()
+        speech_pool.submit(synthesize_utterance, follower)
+
+def play_utterances():
+    global current_utterance
+    while True:
+        _, _, utterance = speech_queue.get()
+        current_utterance = utterance
+        release_followers(utterance)
+        try:
+            if not utterance.cancelled.is_set():
+                play_audio(trace_audio_start(utterance), cancelled=utterance.cancelled)
+                if utterance.started is not None:
+                    record_span("playback", utterance.started, turn=utterance.turn)
+        except Exception as e:
+            print(f"Error in playing speech: {e}")
+        finally:
+            current_utterance = None
+            utterance.done.set()
+
+def start_speech_worker():
+    global speech_worker
+    with speech_lock:
+        if speech_worker is None or not speech_worker.is_alive():
+            speech_worker = threading.Thread(target=play_utterances, daemon=True)
+            speech_worker.start()
+
+def cancel_speech():
+    # Stops the line being spoken and drops everything still queued.
+    playing = current_utterance
+    if playing is not None:
+        playing.cancel()
+    while True:
+        try:
+            _, _, utterance = speech_queue.get_nowait()
+        except queue.Empty:
+            break
+        utterance.cancel()
+        utterance.done.set()
+        release_followers(utterance)
+
+def prewarm_tts_cache(phrases=None, voice_id=DEFAULT_VOICE_ID):
+    for phrase in phrases or TTS_PREWARM_PHRASES:
+        try:
+            if get_cached_speech(phrase, voice_id) is not None:
+                continue
+            response, current_key = request_speech(phrase, voice_id)
+            if response is None:
+                continue
+            try:
+                pcm = b"".join(iter_speech_pcm(response))
+            finally:
+                response.close()
+            track_voice_usage(current_key, len(pcm) / (TTS_SAMPLE_RATE * 2))
+            store_cached_speech(phrase, voice_id, pcm)
+        except Exception as e:
+            print(f"Error pre-warming speech cache: {e}")
+
+def say(text, voice_id=DEFAULT_VOICE_ID, wait=False, priority=SPEECH_PRIORITY_NORMAL, after=None):
+    # Queues the line for the single playback worker while its audio is synthesized on the pool.
+    # With after, synthesis waits until that utterance starts playing.
+    global speech_sequence
+    start_speech_worker()
+    utterance = Utterance(text, voice_id, priority)
+    if turn_cancelled():
+        # A turn that was barged in on finishes silently.
+        utterance.cancel()
+        utterance.done.set()
+        return utterance
+    with speech_lock:
+        speech_sequence += 1
+        sequence = speech_sequence
+        waiting = after is not None and not after.released and not after.cancelled.is_set()
+        if waiting:
+            after.followers.append(utterance)
+        elif after is not None and after.cancelled.is_set():
+            utterance.cancel()
+    if not waiting:
+        speech_pool.submit(synthesize_utterance, utterance)
+    speech_queue.put((priority, sequence, utterance))
+    if wait:
+        utterance.done.wait()
+    return utterance
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text.
+    return len(text) // 4 + 1
+
+def conversation_tokens():
+    return sum(estimate_tokens(part.get("text", "")) for message in conversation_history for part in message["parts"])
+
+def load_conversation():
+    global conversation_history, conversation_summary
+    if os.path.exists(CONVERSATION_FILE):
+        try:
+            with open(CONVERSATION_FILE, "r") as file:
+                data = json.load(file)
+            conversation_history = data.get("history", [])
+            conversation_summary = data.get("summary", "")
+        except (OSError, ValueError) as e:
+            print(f"Error loading conversation: {e}")
+
+def save_conversation():
+    try:
+        with open(CONVERSATION_FILE + ".tmp", "w") as file:
+            json.dump({"summary": conversation_summary, "history": conversation_history}, file)
+        os.replace(CONVERSATION_FILE + ".tmp", CONVERSATION_FILE)
+    except OSError as e:
+        print(f"Error saving conversation: {e}")
+
+load_conversation()
+
+def build_gemini_payload(transcript):
+    with conversation_lock:
+        contents = conversation_history + [{"role": "user", "parts": [{"text": transcript}]}]
+        payload = {"contents": contents}
+        if conversation_summary:
+            payload["systemInstruction"] = {"parts": [{"text": f"Summary of the earlier conversation: {conversation_summary}"}]}
+    return payload
+
+def remember_turn(user_text, model_text):
+    with conversation_lock:
+        conversation_history.append({"role": "user", "parts": [{"text": user_text}]})
+        conversation_history.append({"role": "model", "parts": [{"text": model_text}]})
+        # Older turns leave the verbatim window in user/model pairs so roles keep alternating.
+        folded_turns = []
+        while len(conversation_history) > 2 and (len(conversation_history) > 2 * CONVERSATION_KEEP_TURNS
+                                                 or conversation_tokens() > CONVERSATION_TOKEN_BUDGET):
+            folded_turns.extend(conversation_history[:2])
+            del conversation_history[:2]
+        save_conversation()
+    if folded_turns:
+        threading.Thread(target=summarize_turns, args=(folded_turns,), daemon=True).start()
+
+def summarize_turns(folded_turns):
+    # Folds run one at a time, so each merges into the summary the previous one wrote.
+    with summary_lock:
+        merge_summary(folded_turns)
+
+def merge_summary(folded_turns):
+    global conversation_summary
+    with conversation_lock:
+        current_summary = conversation_summary
+        generation = conversation_generation
+    exchanges = "\n".join(f"{message['role']}: {message['parts'][0].get('text', '')}" for message in folded_turns)
+    prompt = (f"Current summary of a conversation:\n{current_summary or '(empty)'}\n\n"
+              f"Update the summary with these older exchanges. Keep it under {CONVERSATION_SUMMARY_WORDS} words "
+              f"and reply with the summary only.\n{exchanges}")
+    summary = None
+    try:
+        url = f"{GEMINI_API_URL}/v1beta/models/{GEMINI_MODEL}:generateContent"
+        payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        start = time.time()
+        response = http_request("gemini", "POST", url, json=payload, params={"key": API_KEY})
+        log_api_usage("gemini_api", time.time() - start)
+        if response.status_code == 200:
+            parts = response.json().get("candidates", [{}])[0].get("content", {}).get("parts", [])
+            if parts:
+                summary = parts[0].get("text", "").strip()
+    except Exception as e:
+        print(f"Error summarizing conversation: {e}")
+    if not summary:
+        # Keep the most recent words when the summarizer is unavailable.
+        summary = f"{current_summary} {exchanges}".replace("\n", " ")
+    words = summary.split()
+    with conversation_lock:
+        if generation != conversation_generation:
+            return
+        conversation_summary = " ".join(words[-CONVERSATION_SUMMARY_WORDS * 2:])[-CONVERSATION_SUMMARY_WORDS * 8:]
+        save_conversation()
 
-def get_gemini_response(transcript):
-    global conversation_history
+def describe_conversation():
+    with conversation_lock:
+        turns = len(conversation_history) // 2
+        tokens = conversation_tokens() + (estimate_tokens(conversation_summary) if conversation_summary else 0)
+    return f"I remember {turns} recent exchanges, about {tokens} tokens including the summary."
+
+# Answer Cache
+
+def answer_cache_key(question):
+    words = [word for word in normalize_transcript(question).split() if word not in ANSWER_STOPWORDS]
+    return f"{GEMINI_MODEL}:{' '.join(words)}" if words else None
+
+def depends_on_context(question):
+    # Follow-ups ("tell me more about it") and time-sensitive questions must not reuse an old answer.
+    return any(word in ANSWER_CONTEXT_WORDS for word in normalize_transcript(question).split())
+
+def load_answer_cache():
+    if not os.path.exists(ANSWER_CACHE_FILE):
+        return
+    try:
+        with open(ANSWER_CACHE_FILE, "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Error loading answer cache: {e}")
+        return
+    now = time.time()
+    with answer_cache_lock:
+        for key, entry in data.get("answers", []):
+            if now - entry["time"] < ANSWER_CACHE_TTL:
+                answer_cache[key] = entry
+        answer_cache_stats.update(data.get("stats", {}))
+
+def save_answer_cache():
+    # Called with answer_cache_lock held.
+    global answer_cache_dirty
+    answer_cache_dirty = False
+    try:
+        with open(ANSWER_CACHE_FILE + ".tmp", "w") as file:
+            json.dump({"answers": list(answer_cache.items()), "stats": answer_cache_stats}, file)
+        os.replace(ANSWER_CACHE_FILE + ".tmp", ANSWER_CACHE_FILE)
+    except OSError as e:
+        print(f"Error saving answer cache: {e}")
+
+def cached_answer(question, use_cache=True):
+    global answer_cache_dirty
+    key = answer_cache_key(question)
+    with answer_cache_lock:
+        answer_cache_dirty = True
+        if not use_cache or key is None:
+            answer_cache_stats["bypassed"] += 1
+            return None
+        entry = answer_cache.get(key)
+        if entry is None or time.time() - entry["time"] >= ANSWER_CACHE_TTL:
+            answer_cache.pop(key, None)
+            answer_cache_stats["misses"] += 1
+            return None
+        answer_cache.move_to_end(key)
+        answer_cache_stats["hits"] += 1
+    return entry["answer"]
+
+def store_answer(question, answer):
+    key = answer_cache_key(question)
+    if key is None:
+        return
+    with answer_cache_lock:
+        answer_cache[key] = {"question": question, "answer": answer, "time": time.time()}
+        answer_cache.move_to_end(key)
+        while len(answer_cache) > ANSWER_CACHE_SIZE:
+            answer_cache.popitem(last=False)
+        save_answer_cache()
+
+def clear_answer_cache():
+    with answer_cache_lock:
+        answer_cache.clear()
+        save_answer_cache()
+
+def get_answer_cache_stats():
+    with answer_cache_lock:
+        return {"entries": len(answer_cache), **answer_cache_stats}
+
+def flush_answer_cache():
+    # Hit and miss counts are only written with new answers, so they are flushed once more on exit
+    # when they changed since.
+    with answer_cache_lock:
+        if answer_cache_dirty:
+            save_answer_cache()
+
+load_answer_cache()
+atexit.register(flush_answer_cache)
+
+@traced("gemini")
+def get_gemini_response(transcript, use_cache=True):
+    answer = cached_answer(transcript, use_cache)
+    if answer is not None:
+        remember_turn(transcript, answer)
+        return answer
     try:
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
+        url = f"{GEMINI_API_URL}/v1beta/models/{GEMINI_MODEL}:generateContent"
         headers = {"Content-Type": "application/json"}
-        conversation_history.append({"role": "user", "parts": [{"text": transcript}]})
-        payload = {"contents": conversation_history}
+        payload = build_gemini_payload(transcript)
         params = {"key": API_KEY}
-        response = requests.post(url, json=payload, headers=headers, params=params)
-        log_api_usage("gemini_api")
+        start = time.time()
+        response = http_request("gemini", "POST", url, json=payload, headers=headers, params=params)
+        log_api_usage("gemini_api", time.time() - start)
         if response.status_code == 200:
             data = response.json()
             if 'candidates' in data and len(data['candidates']) > 0:
                 parts = data['candidates'][0].get('content', {}).get('parts', [])
                 if len(parts) > 0:
                     response_text = parts[0].get("text", "No content found")
-                    conversation_history.append({"role": "model", "parts": [{"text": response_text}]})
+                    remember_turn(transcript, response_text)
+                    if use_cache:
+                        store_answer(transcript, response_text)
                     return response_text
             return "No candidates found in response."
         else:
@@ -195,254 +1427,1230 @@ def get_gemini_response(transcript):
     except Exception as e:
         return f"Error occurred: {str(e)}"
 
+def stream_gemini_response(transcript, use_cache=True):
+    # Yields text fragments as Gemini generates them; the full answer is added to the history at the end.
+    answer = cached_answer(transcript, use_cache)
+    if answer is not None:
+        remember_turn(transcript, answer)
+        yield answer
+        return
+    response_text = ""
+    response = None
+    complete = False
+    start = time.time()
+    try:
+        url = f"{GEMINI_API_URL}/v1beta/models/{GEMINI_MODEL}:streamGenerateContent"
+        headers = {"Content-Type": "application/json"}
+        payload = build_gemini_payload(transcript)
+        params = {"key": API_KEY, "alt": "sse"}
+        response = http_request("gemini", "POST", url, json=payload, headers=headers, params=params, stream=True)
+        if response.status_code != 200:
+            yield f"Error: {response.status_code} - {response.text}"
+            return
+        response.encoding = "utf-8"
+        for line in response.iter_lines(decode_unicode=True):
+            if turn_cancelled():
+                # Closing the response below aborts the generation mid-stream.
+                break
+            if not line or not line.startswith("data:"):
+                continue
+            data = json.loads(line[5:])
+            candidates = data.get("candidates", [])
+            if not candidates:
+                continue
+            for part in candidates[0].get("content", {}).get("parts", []):
+                text = part.get("text", "")
+                if text:
+                    if not response_text:
+                        record_span("gemini_first_token", start)
+                    response_text += text
+                    yield text
+        else:
+            complete = True
+        if not response_text:
+            yield "No candidates found in response."
+    except Exception as e:
+        yield f"Error occurred: {str(e)}"
+    finally:
+        if response is not None:
+            log_api_usage("gemini_api", time.time() - start)
+            response.close()
+        if response_text:
+            remember_turn(transcript, response_text)
+        # Only answers that streamed to the end are reused.
+        if complete and response_text and use_cache:
+            store_answer(transcript, response_text)
+
+def split_sentences(buffer):
+    sentences = []
+    match = SENTENCE_BOUNDARY.search(buffer)
+    while match:
+        sentence = buffer[:match.end()].strip()
+        buffer = buffer[match.end():]
+        if sentence:
+            sentences.append(sentence)
+        match = SENTENCE_BOUNDARY.search(buffer)
+    return sentences, buffer
+
+# Speech Text Pipeline
+
+LINE_MARKER = re.compile(r"^[ \t]*(?:#{1,6}|>+|[-*+•]|\d{1,3}[.)])[ \t]+", re.M)  # headings, quotes, list markers
+MARKDOWN_RULES = [
+    (re.compile(r"```.*?(?:```|$)", re.S), " "),                             # code blocks are not read out
+    (re.compile(r"`([^`]*)`"), r"\1"),
+    (re.compile(r"!?\[([^\]]*)\]\([^)]*\)"), r"\1"),                         # links keep their text
+    (re.compile(r"https?://\S+"), " "),
+    (re.compile(r"^[ \t]*(?:[-*_][ \t]*){3,}$", re.M), " "),                 # horizontal rules
+    (re.compile(r"^[ \t]*\|?(?:[ \t]*:?-{3,}:?[ \t]*\|?)+[ \t]*$", re.M), " "),  # table header rules
+    (LINE_MARKER, ""),
+    # Operators are spoken as words; only what is left of the markdown is dropped below.
+    (re.compile(r"(?<=\d)[ \t]*\*[ \t]*(?=\d)"), " times "),
+    (re.compile(r"(?<=\d)[ \t]*\^[ \t]*(?=\d)"), " to the power of "),
+    (re.compile(r"(?<=\b[A-Ga-g])#"), " sharp"),
+    (re.compile(r"[ \t]+>=[ \t]+"), " greater than or equal to "),
+    (re.compile(r"[ \t]+<=[ \t]+"), " less than or equal to "),
+    (re.compile(r"[ \t]+>[ \t]+"), " greater than "),
+    (re.compile(r"[ \t]+<[ \t]+"), " less than "),
+    (re.compile(r"(\*{1,3}|_{2,3}|~~)(?=\S)(.+?)(?<=\S)\1"), r"\2"),          # bold, italics, strikethrough
+    (re.compile(r"[ \t]*\|[ \t]*"), ", "),                                   # table cells
+    (re.compile(r"[ \t]*(?:->|→|=>)[ \t]*"), " to "),
+    (re.compile(r"[ \t]*&[ \t]*"), " and "),
+    (re.compile(r"[*#_~{}\[\]\\]+"), " "),
+]
+
+def strip_markdown(text):
+    for pattern, replacement in MARKDOWN_RULES:
+        text = pattern.sub(replacement, text)
+    return text
+
+def clean_speech_text(text):
+    # Strips markdown and symbols the voice would otherwise read out (and bill). Lines such as list
+    # items or headings become sentences of their own.
+    text = strip_markdown(text)
+    lines = []
+    for line in text.splitlines():
+        line = " ".join(line.split()).strip(" ,")
+        if line:
+            lines.append(line if line[-1] in ".!?:;,\"')" else line + ".")
+    return " ".join(lines)
+
+def split_clauses(sentence, limit):
+    # Packs clauses (then words) greedily so no chunk exceeds limit characters.
+    chunks = []
+    current = ""
+    for piece in CLAUSE_BOUNDARY.split(sentence):
+        words = [piece] if len(piece) <= limit else piece.split()
+        for word in words:
+            if current and len(current) + 1 + len(word) > limit:
+                chunks.append(current)
+                current = word
+            else:
+                current = f"{current} {word}" if current else word
+    if current:
+        chunks.append(current)
+    return chunks
+
+def speech_chunks(text, limit=TTS_CHUNK_MAX_CHARS):
+    sentences, rest = split_sentences(clean_speech_text(text) + " ")
+    chunks = []
+    for sentence in sentences + ([rest.strip()] if rest.strip() else []):
+        chunks.extend([sentence] if len(sentence) <= limit else split_clauses(sentence, limit))
+    return chunks
+
+def speak_text(text, spoken=None):
+    # Queues text as a chain of chunks with bounded synthesis lookahead; spoken carries the chain
+    # across calls when an answer arrives piece by piece.
+    spoken = [] if spoken is None else spoken
+    for chunk in speech_chunks(text):
+        gate = spoken[-TTS_LOOKAHEAD_CHUNKS] if len(spoken) >= TTS_LOOKAHEAD_CHUNKS else None
+        spoken.append(say(chunk, after=gate))
+    return spoken
+
+class SpeechTextStream:
+    # Turns markdown arriving in fragments into speakable sentences. A line is cleaned once its first
+    # word is known, so list markers and headings never reach the sentence splitter, and lines inside
+    # a code fence are skipped whole.
+    def __init__(self):
+        self.line = ""
+        self.line_started = False
+        self.in_code = False
+        self.pending = ""
+
+    def feed(self, fragment):
+        self.line += fragment
+        while "\n" in self.line:
+            line, self.line = self.line.split("\n", 1)
+            self.end_line(line)
+        self.release_partial_line()
+        sentences, self.pending = split_sentences(self.pending)
+        return sentences
+
+    def finish(self):
+        if self.line.strip():
+            self.end_line(self.line)
+        self.line = ""
+        sentences, rest = split_sentences(self.pending)
+        self.pending = ""
+        return sentences + ([rest.strip()] if rest.strip() else [])
+
+    def end_line(self, line):
+        if line.lstrip().startswith("```"):
+            self.in_code = not self.in_code
+        elif not self.in_code:
+            cleaned = clean_speech_text(line)
+            if cleaned:
+                self.pending += cleaned + " "
+        self.line_started = False
+
+    def release_partial_line(self):
+        # Complete sentences of a long line are spoken before its newline arrives.
+        stripped = self.line.lstrip()
+        if self.in_code or not stripped or stripped[0] in "`|" or not re.search(r"\s", stripped):
+            return
+        if not self.line_started:
+            self.line = LINE_MARKER.sub("", self.line)
+            self.line_started = True
+        matches = list(SENTENCE_BOUNDARY.finditer(self.line))
+        if matches:
+            end = matches[-1].end()
+            self.pending += " ".join(strip_markdown(self.line[:end]).split()) + " "
+            self.line = self.line[end:]
+
+@traced("gemini")
+def speak_gemini_response(transcript, use_cache=True):
+    # Queues each sentence as soon as it is complete while Gemini keeps generating the rest.
+    response_text = ""
+    spoken = []
+    text_stream = SpeechTextStream()
+    for fragment in stream_gemini_response(transcript, use_cache):
+        print(fragment, end="", flush=True)
+        response_text += fragment
+        for sentence in text_stream.feed(fragment):
+            speak_text(sentence, spoken)
+    print()
+    for sentence in text_stream.finish():
+        speak_text(sentence, spoken)
+    return response_text
+
 #leopard = pvleopard.create(access_key=LEOPARD_ACCESS_KEY)
 
-def takeCommand():
-    r = sr.Recognizer()
-    r.pause_threshold = 1.0 
-    with sr.Microphone() as source:
-        print("Adjusting for ambient noise...")
-        r.adjust_for_ambient_noise(source, duration=0.5) 
-        print("Listening for command...")
+class AudioRingBuffer:
+    # Fixed-size buffer of capture frames. Readers keep their own cursor (a running frame count),
+    # so the wake-word detector and the command recognizer consume the same audio independently.
+    def __init__(self, frame_length, capacity):
+        self.frames = np.zeros((capacity, frame_length), dtype=np.int16)
+        self.capacity = capacity
+        self.write_index = 0
+        self.condition = threading.Condition()
+
+    def write(self, frame):
+        with self.condition:
+            self.frames[self.write_index % self.capacity] = frame
+            self.write_index += 1
+            self.condition.notify_all()
+
+    def latest(self):
+        with self.condition:
+            return self.write_index
+
+    def read(self, cursor, timeout=None):
+        with self.condition:
+            # A reader that fell behind by more than the capacity skips to the oldest frame still held.
+            cursor = max(cursor, self.write_index - self.capacity, 0)
+            while cursor >= self.write_index:
+                if not self.condition.wait(timeout):
+                    return None, cursor
+            return self.frames[cursor % self.capacity].copy(), cursor + 1
+
+def frames_for(seconds):
+    return int(seconds * CAPTURE_SAMPLE_RATE / CAPTURE_FRAME_LENGTH)
+
+def capture_audio():
+    while capture_running:
+        stream = None
         try:
-            audio = r.listen(source, timeout=8, phrase_time_limit=12)
-            print("Recognizing...")
-            transcript = r.recognize_google(audio, language="en-in")
-            print(f"User said: {transcript}")
-            return transcript
-        except sr.WaitTimeoutError:
-            return None  
+            stream = get_audio_interface().open(
+                format=pyaudio.paInt16,
+                channels=1,
+                rate=CAPTURE_SAMPLE_RATE,
+                input=True,
+                frames_per_buffer=CAPTURE_FRAME_LENGTH
+            )
+            while capture_running:
+                audio_data = stream.read(CAPTURE_FRAME_LENGTH, exception_on_overflow=False)
+                capture_ring.write(np.frombuffer(audio_data, dtype=np.int16))
         except Exception as e:
-            print(f"Error in recognizing speech: {e}")
-            return None
+            print(f"Error capturing audio: {e}")
+            time.sleep(1)
+        finally:
+            if stream is not None:
+                stream.stop_stream()
+                stream.close()
+
+def start_capture_engine():
+    global capture_ring, capture_thread, capture_running, noise_thread
+    with capture_lock:
+        if capture_thread is None or not capture_thread.is_alive():
+            if capture_ring is None:
+                capture_ring = AudioRingBuffer(CAPTURE_FRAME_LENGTH, frames_for(CAPTURE_BUFFER_SECONDS))
+            capture_running = True
+            capture_thread = threading.Thread(target=capture_audio, daemon=True)
+            capture_thread.start()
+        if noise_thread is None or not noise_thread.is_alive():
+            noise_thread = threading.Thread(target=track_noise_floor, daemon=True)
+            noise_thread.start()
+        return capture_ring
+
+def frame_energy(frame):
+    return float(np.sqrt(np.mean(frame.astype(np.float32) ** 2)))
+
+def speech_threshold():
+    return max(noise_floor * VAD_SPEECH_RATIO, VAD_MIN_ENERGY)
+
+def track_noise_floor():
+    # Falls quickly towards quieter frames and rises slowly, so speech barely moves the estimate.
+    global noise_floor
+    cursor = capture_ring.latest()
+    while capture_running:
+        frame, cursor = capture_ring.read(cursor, timeout=1)
+        if frame is None:
+            continue
+        energy = frame_energy(frame)
+        if energy < noise_floor:
+            noise_floor = noise_floor * 0.9 + energy * 0.1
+        elif energy < speech_threshold():
+            noise_floor = noise_floor * 0.995 + energy * 0.005
+        else:
+            noise_floor = noise_floor * 0.9995 + energy * 0.0005
+
+def iter_utterance(ring, cursor, timeout=8, phrase_time_limit=12, endpoint=None):
+    # Yields the speech segment frame by frame (pre-roll first) as it is captured, so a streaming
+    # recognizer can work while the user is still talking. At the endpoint, endpoint["trim"] is set to
+    # the number of trailing silence frames beyond VAD_TRAILING_SECONDS.
+    sr = require_module("speech_recognition")
+    preroll_frames = frames_for(VAD_PREROLL_SECONDS)
+    trailing_frames = frames_for(VAD_TRAILING_SECONDS)
+    frame_seconds = CAPTURE_FRAME_LENGTH / CAPTURE_SAMPLE_RATE
+    frames = []
+    speech_run = 0
+    silence_run = 0
+    speech_frames = 0
+    waited = 0.0
+    while True:
+        frame, cursor = ring.read(cursor)
+        is_speech = frame_energy(frame) > speech_threshold()
+        if speech_frames == 0:
+            frames.append(frame)
+            waited += frame_seconds
+            speech_run = speech_run + 1 if is_speech else 0
+            if speech_run >= VAD_START_FRAMES:
+                speech_start = max(0, len(frames) - speech_run - preroll_frames)
+                speech_frames = len(frames) - speech_start
+                yield from frames[speech_start:]
+            elif waited >= timeout:
+                raise sr.WaitTimeoutError("listening timed out while waiting for phrase to start")
+            elif len(frames) > preroll_frames + VAD_START_FRAMES:
+                del frames[0]
+            continue
+        speech_frames += 1
+        yield frame
+        silence_run = 0 if is_speech else silence_run + 1
+        speech_seconds = (speech_frames - silence_run) * frame_seconds
+        hangover = min(VAD_HANGOVER_SECONDS + VAD_HANGOVER_GROWTH * speech_seconds, VAD_MAX_HANGOVER_SECONDS)
+        if silence_run * frame_seconds >= hangover or speech_frames * frame_seconds >= phrase_time_limit:
+            break
+    if endpoint is not None:
+        endpoint["trim"] = max(0, silence_run - trailing_frames)
+        endpoint["time"] = time.time()
+
+def utterance_audio(frames, endpoint):
+    # Returns the captured speech segment without its excess trailing silence as sr.AudioData.
+    sr = require_module("speech_recognition")
+    return sr.AudioData(np.concatenate(frames[:len(frames) - endpoint["trim"]]).tobytes(), CAPTURE_SAMPLE_RATE, 2)
+
+def stop_capture_engine():
+    global capture_running
+    capture_running = False
+
+def get_porcupine():
+    global porcupine_handle
+    if porcupine_handle is None:
+        porcupine_handle = pvporcupine.create(
+            access_key=os.getenv('PORC_API_KEY'),
+            keyword_paths=[WAKE_WORD_PATH]
+        )
+    return porcupine_handle
+
+# Speech Recognition Backends
+
+class GoogleRecognizerBackend:
+    def __init__(self):
+        self.recognizer = require_module("speech_recognition").Recognizer()
+
+    def recognize(self, frames, endpoint):
+        sr = require_module("speech_recognition")
+        audio = utterance_audio(list(frames), endpoint)
+        try:
+            yield self.recognizer.recognize_google(audio, language=RECOGNIZER_LANGUAGE), True
+        except sr.UnknownValueError:
+            return
+
+class VoskRecognizerBackend:
+    # Offline streaming recognizer; needs the vosk package and a model at VOSK_MODEL_PATH.
+    def __init__(self):
+        vosk = require_module("vosk")
+        self.vosk = vosk
+        self.model = vosk.Model(os.getenv('VOSK_MODEL_PATH', "vosk-model"))
+
+    def recognize(self, frames, endpoint):
+        recognizer = self.vosk.KaldiRecognizer(self.model, CAPTURE_SAMPLE_RATE)
+        for frame in frames:
+            if recognizer.AcceptWaveform(frame.tobytes()):
+                continue
+            partial = json.loads(recognizer.PartialResult()).get("partial", "")
+            if partial:
+                yield partial, False
+        text = json.loads(recognizer.FinalResult()).get("text", "")
+        if text:
+            yield text, True
+
+class FakeRecognizerBackend:
+    # Replays a scripted transcript as a partial hypothesis per frame that gains one word every
+    # frames_per_word frames, then answers with the full transcript after latency seconds.
+    def __init__(self, transcript="", frames_per_word=8, latency=0.0):
+        self.transcript = transcript
+        self.frames_per_word = frames_per_word
+        self.latency = latency
+
+    def recognize(self, frames, endpoint):
+        words = self.transcript.split()
+        for index, _ in enumerate(frames, 1):
+            shown = min(len(words), index // self.frames_per_word)
+            if shown:
+                yield " ".join(words[:shown]), False
+        time.sleep(self.latency)
+        if self.transcript:
+            yield self.transcript, True
+
+# A backend's recognize(frames, endpoint) consumes capture frames while they arrive and yields
+# (text, final) hypotheses; endpoint["trim"] is set once frames is exhausted. Backends without
+# partial results yield a single final hypothesis after the endpoint.
+RECOGNIZER_BACKENDS = {
+    "google": GoogleRecognizerBackend,
+    "vosk": VoskRecognizerBackend,
+    "fake": FakeRecognizerBackend,
+}
+
+def get_recognizer_backend():
+    global recognizer_backend
+    if recognizer_backend is None:
+        recognizer_backend = RECOGNIZER_BACKENDS[RECOGNIZER_BACKEND]()
+    return recognizer_backend
+
+def early_commit_candidate(partial):
+    # Only short, complete control commands qualify. Returns the normalized text and how long it
+    # has to stay unchanged.
+    if len(partial.split()) > EARLY_COMMIT_MAX_WORDS:
+        return None, None
+    intent, slots = match_intent(partial)
+    if intent is None or intent.name not in EARLY_COMMIT_INTENTS:
+        return None, None
+    if intent.name == "volume":
+        if slots.get("volume") is None or not re.search(r"\d", slots["text"]):
+            return None, None
+        return slots["text"], EARLY_COMMIT_LEVEL_STABLE_SECONDS
+    return slots["text"], EARLY_COMMIT_STABLE_SECONDS
+
+def takeCommand(early_commit=False):
+    global command_cursor, command_captures
+    if turn_cancelled():
+        # A turn that was barged in on must not take the next command as its own answer.
+        return None
+    ring = start_capture_engine()
+    # Right after the wake word, listening resumes exactly where the detector stopped.
+    cursor = command_cursor if command_cursor is not None else ring.latest()
+    command_cursor = None
+    sr = load_module("speech_recognition")
+    if sr is None:
+        return None
+    print("Listening for command...")
+    start = time.time()
+    endpoint = {}
+    hypotheses = get_recognizer_backend().recognize(iter_utterance(ring, cursor, 8, 12, endpoint), endpoint)
+    candidate, stable_since = None, None
+    # The wake word is not a barge-in while the user is already giving a command.
+    with command_capture_lock:
+        command_captures += 1
+    try:
+        for text, final in hypotheses:
+            if final:
+                record_span("capture", start, endpoint.get("time"))
+                record_span("recognition", endpoint.get("time", start))
+                print(f"User said: {text}")
+                return text
+            if not early_commit:
+                continue
+            partial, stable_seconds = early_commit_candidate(text)
+            if partial != candidate:
+                candidate, stable_since = partial, time.time()
+            elif candidate and time.time() - stable_since >= stable_seconds:
+                record_span("capture", start, early=True)
+                print(f"User said: {text} (committed early)")
+                return text
+        return None
+    except sr.WaitTimeoutError:
+        return None
+    except Exception as e:
+        print(f"Error in recognizing speech: {e}")
+        return None
+    finally:
+        with command_capture_lock:
+            command_captures -= 1
+        hypotheses.close()
 
 def set_system_volume(volume_percentage):
     volume_level = volume_percentage / 100.0
     volume_level = max(0.0, min(1.0, volume_level))
-    devices = AudioUtilities.GetSpeakers()
-    interface = devices.Activate(IAudioEndpointVolume._iid_, CLSCTX_ALL, None)
-    volume = interface.QueryInterface(IAudioEndpointVolume)
+    pycaw = require_module("pycaw.pycaw")
+    devices = pycaw.AudioUtilities.GetSpeakers()
+    interface = devices.Activate(pycaw.IAudioEndpointVolume._iid_, require_module("comtypes").CLSCTX_ALL, None)
+    volume = interface.QueryInterface(pycaw.IAudioEndpointVolume)
     volume.SetMasterVolumeLevelScalar(volume_level, None)
     print(f"System volume set to {volume_percentage}%")
 
-def process_volume_command(transcript):
-    transcript = transcript.lower()
-    if any(cmd in transcript for cmd in ["set volume to", "volume to", "volume"]):
-        number_words = {
-            "zero": 0, "ten": 10, "twenty": 20, "thirty": 30,
-            "forty": 40, "fifty": 50, "sixty": 60, "seventy": 70,
-            "eighty": 80, "ninety": 90, "hundred": 100
-        }
-        match = re.search(r'(\d{1,3})%?', transcript)
-        if match:
-            volume_percentage = int(match.group(1))
-        else:
-            for word, num in number_words.items():
-                if word in transcript:
-                    volume_percentage = num
-                    break
-            else:
-                volume_percentage = None
-
-        if volume_percentage is not None and 0 <= volume_percentage <= 100:
-            set_system_volume(volume_percentage)
-            return True
-
-        say("Please specify a valid percentage")
-        return False
-
-    return False
-
-
-def wakeUp():
-    porcupine = pvporcupine.create(
-        access_key=os.getenv('PORC_API_KEY'),
-        keyword_paths=[r"C:\Users\mangr\OneDrive\Desktop\Assistant\Hey-Grace_en_windows_v3_0_0.ppn"]
-    )
-    p = pyaudio.PyAudio()
-    stream = p.open(
-        format=pyaudio.paInt16,
-        channels=1,
-        rate=16000,
-        input=True,
-        frames_per_buffer=512
-    )
-    print("Listening for wake word...")
+# Wake Word and Barge-in
+
+def wake_word_loop():
+    # Runs for the whole session, also while a turn is being handled or spoken.
+    global echo_gain
+    ring = start_capture_engine()
+    porcupine = get_porcupine()
+    cursor = ring.latest()
+    recent = deque(maxlen=frames_for(BARGE_IN_WINDOW_SECONDS))
+    print("Listening for wake word...", flush=True)
+    wake_loop_ready.set()
     while True:
         try:
-            audio_data = stream.read(512)
-            audio_data = np.frombuffer(audio_data, dtype=np.int16)
-            result = porcupine.process(audio_data)
-            if result >= 0:
-                say("uh huh...")
-                print("Wake word detected!")
-                return True
-            time.sleep(0.01) 
+            frame, cursor = ring.read(cursor)
+            energy = frame_energy(frame)
+            recent.append(energy)
+            playing = time.time() - playback_time < PLAYBACK_REFERENCE_HOLD and playback_energy > 0
+            if playing:
+                # How loud our own voice comes back through the microphone; falls fast, rises slowly.
+                gain = energy / playback_energy
+                echo_gain = echo_gain * 0.9 + gain * 0.1 if gain < echo_gain else echo_gain * 0.995 + gain * 0.005
+            result = porcupine.process(frame)
+            if result < 0 or command_captures > 0:
+                continue
+            if playing and sum(recent) / len(recent) < BARGE_IN_ECHO_MARGIN * echo_gain * playback_energy:
+                print("Ignored a wake word in the playback echo.")
+                continue
+            detected = time.time()
+            # The frame that completed the wake word was captured this long before detection.
+            backlog = (ring.latest() - cursor + 1) * CAPTURE_FRAME_LENGTH / CAPTURE_SAMPLE_RATE
+            barged_in = cancel_turns()
+            wake_queue.put((cursor, detected - backlog, detected, barged_in))
         except Exception as e:
             print(f"Error: {e}")
             continue
 
+def start_wake_word_loop():
+    global wake_thread
+    with wake_lock:
+        if wake_thread is None or not wake_thread.is_alive():
+            wake_thread = threading.Thread(target=wake_word_loop, daemon=True)
+            wake_thread.start()
+
+def turn_cancelled():
+    cancelled = getattr(turn_context, "cancelled", None)
+    return cancelled is not None and cancelled.is_set()
+
+def cancel_turns():
+    # Stops playback at once and tells every turn still in flight to drop its remaining work.
+    # Returns whether anything was interrupted.
+    with turn_lock:
+        interrupted = bool(active_turns) or current_utterance is not None or not speech_queue.empty()
+        for cancelled in active_turns:
+            cancelled.set()
+    cancel_speech()
+    return interrupted
+
+def run_turn(transcript):
+    # Each command runs on its own thread so the main loop can take the next wake word right away.
+    cancelled = threading.Event()
+    turn_context.cancelled = cancelled
+    with turn_lock:
+        active_turns.add(cancelled)
+    try:
+        dispatch_command(transcript)
+    except SystemExit:
+        wake_queue.put(None)
+    finally:
+        with turn_lock:
+            active_turns.discard(cancelled)
+
+def wakeUp():
+    global command_cursor
+    if wake_loop_ready.is_set():
+        print("Listening for wake word...", flush=True)
+    start_wake_word_loop()
+    detection = wake_queue.get()
+    if detection is None:
+        # "quit yourself" ran on a turn thread; the process exits from the main thread.
+        raise SystemExit
+    cursor, started, detected, barged_in = detection
+    start_turn(started)
+    record_span("wake", current_turn_start, detected, barge_in=barged_in)
+    command_cursor = cursor
+    if HTTP_WARM_ON_WAKE:
+        threading.Thread(target=warm_http_connections, daemon=True).start()
+    say("uh huh...")
+    print("Wake word detected!")
+    return True
+
+def run_youtube_control(action):
+    # Pages opened before the script was registered get it injected on first use.
+    return driver.execute_script(
+        f"if (!window.__graceControl) {{ {YOUTUBE_CONTROL_SCRIPT} }} return window.__graceControl.{action}();"
+    )
+
+@traced("youtube")
 def selenium_play_pause():
     try:
-        script = """
-        var video = document.querySelector('video');
-        if(video){
-            if(video.paused) {
-                video.play();
-            } else {
-                video.pause();
-            }
-            return video.paused;
-        }
-        return null;
-        """
-        paused_state = driver.execute_script(script)
+        paused_state = run_youtube_control("toggle")
         print("Toggled play/pause on YouTube. Now paused:", paused_state)
     except Exception as e:
         print("Error toggling play/pause:", e)
 
+@traced("youtube")
 def selenium_next_video():
     try:
-        next_button = driver.find_element(By.CSS_SELECTOR, 'a.ytp-next-button')
-        next_button.click()
-        print("Clicked the next button.")
+        if run_youtube_control("next"):
+            print("Clicked the next button.")
+        else:
+            print("No next button on the page.")
     except Exception as e:
         print("Error clicking next button:", e)
 
-def initialize_driver():
-    global driver
-    if driver is not None:
-        try:
-            driver.title 
-            return
-        except:
-            pass  
+def driver_alive():
+    try:
+        driver.title
+        return True
+    except Exception:
+        return False
+
+def launch_driver():
+    uc = require_module("undetected_chromedriver")
     chrome_options = uc.ChromeOptions()
-    chrome_options.binary_location = r"C:\Users\mangr\AppData\Local\BraveSoftware\Brave-Browser\Application\brave.exe"
+    chrome_options.binary_location = BROWSER_BINARY
     #chrome_options.add_argument("--load-extension=C:\\Users\\LEGION\\OneDrive\\Desktop\\Python Shit\\A.I Assistant\\uBlock")
     #chrome_options.add_argument("--disable-extensions-except=C:\\Users\\LEGION\\OneDrive\\Desktop\\Python Shit\\A.I Assistant\\uBlock")
     #chrome_options.add_argument("--disable-features=PreloadMediaEngagementData,MediaEngagementBypassAutoplayPolicies")
    #chrome_options.add_argument("--window-size=1200,800")
-    driver = uc.Chrome(options=chrome_options)
+    browser = uc.Chrome(options=chrome_options)
+    browser.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": YOUTUBE_CONTROL_SCRIPT})
+    return browser
 
+def initialize_driver():
+    global driver
+    with driver_lock:
+        if driver is not None and driver_alive():
+            return
+        driver = launch_driver()
+
+def warm_browser():
+    # Launches the browser and loads YouTube once so the first command finds it hot.
+    try:
+        initialize_driver()
+        with driver_lock:
+            driver.get(YOUTUBE_URL)
+    except Exception as e:
+        print(f"Error warming browser: {e}")
+
+def monitor_browser():
+    # Relaunches a browser that went away, off the command path, but only once between YouTube
+    # commands and without opening a page: a window the user closes again stays closed until the
+    # next command needs it.
+    global driver, browser_relaunch_allowed
+    warm_browser()
+    while True:
+        time.sleep(BROWSER_HEALTH_INTERVAL)
+        if driver is None or driver_lock.locked() or driver_alive():
+            continue
+        if browser_relaunch_allowed:
+            print("Browser went away, relaunching.")
+            browser_relaunch_allowed = False
+            try:
+                initialize_driver()
+            except Exception as e:
+                print(f"Error relaunching browser: {e}")
+        else:
+            print("Browser was closed; it reopens with the next YouTube command.")
+            with driver_lock:
+                driver = None
+
+def resolve_youtube_video(search_transcript):
+    query = " ".join(search_transcript.lower().split())
+    with youtube_cache_lock:
+        if query in youtube_cache:
+            youtube_cache.move_to_end(query)
+            return youtube_cache[query]
+    response = http_request("youtube", "GET", f"{YOUTUBE_URL}/results", params={"search_query": query},
+                            headers={"Accept-Language": "en-US,en;q=0.9"})
+    response.raise_for_status()
+    match = (re.search(r'"videoRenderer":\{"videoId":"([\w-]{11})"', response.text)
+             or re.search(r'/watch\?v=([\w-]{11})', response.text))
+    if not match:
+        return None
+    video_id = match.group(1)
+    with youtube_cache_lock:
+        youtube_cache[query] = video_id
+        while len(youtube_cache) > YOUTUBE_CACHE_SIZE:
+            youtube_cache.popitem(last=False)
+    return video_id
+
+@traced("youtube")
 def play_on_youtube(search_transcript):
+    global browser_relaunch_allowed
+    browser_relaunch_allowed = True
     try:
-        initialize_driver()  
-        search_url = f"https://www.youtube.com/results?search_query={search_transcript.replace(' ', '+')}"
-        driver.get(search_url)
-        wait = WebDriverWait(driver, 10)  
-        first_video = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "a#video-title")))
-        first_video.click()
+        video_id = None
+        try:
+            video_id = resolve_youtube_video(search_transcript)
+        except Exception as e:
+            print(f"Error resolving video, falling back to the results page: {e}")
+        initialize_driver()
+        if video_id:
+            driver.get(f"{YOUTUBE_URL}/watch?v={video_id}")
+        else:
+            search_url = f"{YOUTUBE_URL}/results?search_query={search_transcript.replace(' ', '+')}"
+            driver.get(search_url)
+            By = require_module("selenium.webdriver.common.by").By
+            EC = require_module("selenium.webdriver.support.expected_conditions")
+            wait = require_module("selenium.webdriver.support.ui").WebDriverWait(driver, 10)
+            first_video = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "a#video-title")))
+            first_video.click()
         print(f"Playing: {search_transcript}")
     except Exception as e:
         print("Error playing video:", e)
 
+def get_spotify():
+    global sp
+    with spotify_client_lock:
+        if sp is None:
+            spotipy = require_module("spotipy")
+            sp = spotipy.Spotify(auth_manager=require_module("spotipy.oauth2").SpotifyOAuth(
+                client_id=os.getenv('SPOTIFY_CLIENT_ID'),
+                client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'),
+                redirect_uri=os.getenv('SPOTIFY_REDIRECT_URI'),
+                scope=SPOTIFY_SCOPE
+            ))
+        return sp
+
+def spotify_exception_type():
+    # Evaluated in except clauses; catches nothing when spotipy never loaded.
+    spotipy = load_module("spotipy")
+    return spotipy.SpotifyException if spotipy else ()
+
+def fetch_spotify_playlists():
+    results = get_spotify().current_user_playlists(limit=50)
+    playlists = results['items']
+    while results.get('next'):
+        results = get_spotify().next(results)
+        playlists.extend(results['items'])
+    return playlists
+
+spotify_fetchers = {
+    "playback": lambda: get_spotify().current_playback(),
+    "devices": lambda: get_spotify().devices().get('devices', []),
+    "playlists": fetch_spotify_playlists,
+    "genre_seeds": lambda: get_spotify().recommendation_genre_seeds()["genres"],
+}
+
+def refresh_spotify_resource(name):
+    value = spotify_fetchers[name]()
+    with spotify_cache_lock:
+        spotify_cache[name] = (value, time.time())
+    return value
+
+def refresh_spotify_resource_async(name):
+    with spotify_cache_lock:
+        if name in spotify_refreshing:
+            return
+        spotify_refreshing.add(name)
+
+    def refresh():
+        try:
+            refresh_spotify_resource(name)
+        except Exception as e:
+            print(f"Error refreshing Spotify {name}: {e}")
+        finally:
+            with spotify_cache_lock:
+                spotify_refreshing.discard(name)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+def get_spotify_resource(name, fresh=False):
+    # Serves cached values; stale ones are returned while a background refresh runs.
+    with spotify_cache_lock:
+        entry = spotify_cache.get(name)
+    if entry is not None and not fresh and (entry[0] or name not in SPOTIFY_CACHE_REFETCH_EMPTY):
+        value, fetched_at = entry
+        age = time.time() - fetched_at
+        if age <= SPOTIFY_CACHE_TTLS[name]:
+            return value
+        if age <= SPOTIFY_CACHE_TTLS[name] * SPOTIFY_CACHE_MAX_STALE:
+            refresh_spotify_resource_async(name)
+            return value
+    return refresh_spotify_resource(name)
+
+def invalidate_spotify_cache(name=None):
+    with spotify_cache_lock:
+        if name is None:
+            spotify_cache.clear()
+        else:
+            spotify_cache.pop(name, None)
+
+def warm_spotify_cache():
+    for name in spotify_fetchers:
+        try:
+            refresh_spotify_resource(name)
+        except Exception as e:
+            print(f"Error warming Spotify {name}: {e}")
+
+def get_spotify_device_id():
+    devices = get_spotify_resource("devices")
+    return devices[0]['id'] if devices else None
+
+def run_on_spotify_device(action):
+    # Runs action(device_id) and returns the device used, or None when no device is available.
+    # A cached device that has gone away is dropped and the action retried once on a fresh list.
+    device_id = get_spotify_device_id()
+    if device_id is None:
+        return None
+    try:
+        action(device_id)
+    except spotify_exception_type() as e:
+        if e.http_status != 404 and "device" not in str(e).lower():
+            raise
+        invalidate_spotify_cache("devices")
+        device_id = get_spotify_device_id()
+        if device_id is None:
+            return None
+        action(device_id)
+    refresh_spotify_resource_async("playback")
+    return device_id
+
+# Spotify Library Mirror
+
+class LibraryIndex:
+    # Token index over library names. Candidates come from the rarest query tokens, so common
+    # words like "the" or "love" never force a scan of most of the library.
+    def __init__(self, entries):
+        self.entries = entries
+        self.postings = {}
+        self.name_tokens = []
+        self.artist_tokens = []
+        self.tokens = []
+        for position, entry in enumerate(entries):
+            name_tokens = set(library_tokens(entry["name"]))
+            artist_tokens = set(library_tokens(entry.get("artist", "")))
+            tokens = name_tokens | artist_tokens
+            self.name_tokens.append(name_tokens)
+            self.artist_tokens.append(artist_tokens)
+            self.tokens.append(tokens)
+            for token in tokens:
+                self.postings.setdefault(token, []).append(position)
+        self.vocabulary = sorted(self.postings)
+
+    def expand(self, token):
+        # Spoken tokens often stop short ("remaster" for "remastered"); prefixes count as matches
+        # when the token is not a word of the library on its own.
+        if len(token) <= 2 or token in self.postings:
+            return [token] if token in self.postings else []
+        start = bisect.bisect_left(self.vocabulary, token)
+        matches = []
+        for word in self.vocabulary[start:]:
+            if not word.startswith(token):
+                break
+            matches.append(word)
+        return matches
+
+    def candidates(self, expansions):
+        sized = sorted(((sum(len(self.postings[word]) for word in words), words) for words in expansions if words),
+                       key=lambda item: item[0])
+        positions = set()
+        for size, words in sized:
+            if positions and size > SPOTIFY_LIBRARY_CANDIDATE_LIMIT:
+                break
+            for word in words:
+                positions.update(self.postings[word])
+        return positions
+
+    def lookup(self, query, artist="", threshold=SPOTIFY_LIBRARY_MATCH_THRESHOLD, coverage=0.0):
+        query_tokens = library_tokens(query)
+        artist_tokens = library_tokens(artist)
+        if not query_tokens:
+            return None
+        query_words = [set(self.expand(token)) for token in query_tokens]
+        artist_words = [set(self.expand(token)) for token in artist_tokens]
+        best, best_score, best_coverage = None, 0, 0
+        for position in self.candidates(query_words + artist_words):
+            name_tokens = self.name_tokens[position]
+            if not name_tokens:
+                continue
+            tokens = self.tokens[position]
+            query_hits = [words & tokens for words in query_words]
+            name_coverage = len(name_tokens & set().union(*query_hits)) / len(name_tokens)
+            query_coverage = sum(1 for hits in query_hits if hits) / len(query_tokens)
+            score = (name_coverage + query_coverage) / 2
+            if artist_tokens:
+                artist_hits = sum(1 for words in artist_words if words & self.artist_tokens[position])
+                score = score * 0.8 + 0.2 * artist_hits / len(artist_tokens)
+            if score > best_score:
+                best, best_score, best_coverage = self.entries[position], score, min(name_coverage, query_coverage)
+        return best if best_score >= threshold and best_coverage >= coverage else None
+
+def library_tokens(text):
+    text = re.sub(r"\((?:feat|ft|with)\.?[^)]*\)|\([^)]*(?:remaster|version|edit|mix|live)[^)]*\)|\s-\s.*(?:remaster|version|edit|mix).*$", "", text.lower())
+    return re.findall(r"[a-z0-9]+", text.replace("&", " and ").replace("'", ""))
+
+def get_library_db():
+    global spotify_library_db
+    if spotify_library_db is None:
+        spotify_library_db = sqlite3.connect(SPOTIFY_LIBRARY_DB, check_same_thread=False)
+        spotify_library_db.executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (uri TEXT PRIMARY KEY, id TEXT, name TEXT, artist TEXT, artist_id TEXT);
+            CREATE TABLE IF NOT EXISTS saved_tracks (uri TEXT PRIMARY KEY, added_at TEXT);
+            CREATE TABLE IF NOT EXISTS playlists (uri TEXT PRIMARY KEY, id TEXT, name TEXT, snapshot_id TEXT);
+            CREATE TABLE IF NOT EXISTS playlist_tracks (playlist_uri TEXT, position INTEGER, track_uri TEXT,
+                                                        PRIMARY KEY (playlist_uri, position));
+        """)
+    return spotify_library_db
+
+def track_row(track):
+    artist = track['artists'][0] if track.get('artists') else {}
+    return (track['uri'], track.get('id'), track['name'], artist.get('name', ""), artist.get('id'))
+
+def fetch_saved_tracks(known):
+    # Saved tracks come newest first, so a delta sync stops at the first one already mirrored.
+    results = get_spotify().current_user_saved_tracks(limit=50)
+    total = results['total']
+    items = []
+    while True:
+        for item in results['items']:
+            if item['track']['uri'] in known:
+                return items, total
+            items.append(item)
+        if not results.get('next'):
+            return items, total
+        results = get_spotify().next(results)
+
+def sync_saved_tracks(db):
+    known = {row[0] for row in db.execute("SELECT uri FROM saved_tracks")}
+    items, total = fetch_saved_tracks(known)
+    if len(known) + len(items) != total:
+        # Something was unliked; only a full pass can tell what.
+        items, total = fetch_saved_tracks(set())
+        db.execute("DELETE FROM saved_tracks")
+    db.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", [track_row(item['track']) for item in items])
+    db.executemany("INSERT OR REPLACE INTO saved_tracks VALUES (?, ?)",
+                   [(item['track']['uri'], item['added_at']) for item in items])
+    return len(items)
+
+def fetch_playlist_tracks(playlist_id):
+    results = get_spotify().playlist_items(playlist_id, fields="items(track(uri,id,name,artists(id,name))),next",
+                                additional_types=("track",))
+    tracks = []
+    while True:
+        tracks.extend(item['track'] for item in results['items'] if item.get('track') and item['track'].get('uri'))
+        if not results.get('next'):
+            return tracks
+        results = get_spotify().next(results)
+
+def sync_playlists(db):
+    # Playlist tracks are refetched only when Spotify reports a new snapshot of the playlist.
+    playlists = refresh_spotify_resource("playlists")
+    snapshots = dict(db.execute("SELECT uri, snapshot_id FROM playlists"))
+    changed = 0
+    for playlist in playlists:
+        if snapshots.pop(playlist['uri'], None) == playlist['snapshot_id']:
+            continue
+        try:
+            tracks = fetch_playlist_tracks(playlist['id'])
+        except spotify_exception_type() as e:
+            # Some playlists (Spotify-owned, editorial) refuse their items; without a stored snapshot
+            # they are simply tried again on the next sync.
+            print(f"Skipping playlist {playlist['name']}: {e}")
+            continue
+        db.execute("DELETE FROM playlist_tracks WHERE playlist_uri = ?", (playlist['uri'],))
+        db.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", [track_row(track) for track in tracks])
+        db.executemany("INSERT INTO playlist_tracks VALUES (?, ?, ?)",
+                       [(playlist['uri'], position, track['uri']) for position, track in enumerate(tracks)])
+        db.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?)",
+                   (playlist['uri'], playlist['id'], playlist['name'], playlist['snapshot_id']))
+        changed += 1
+    for uri in snapshots:
+        db.execute("DELETE FROM playlist_tracks WHERE playlist_uri = ?", (uri,))
+        db.execute("DELETE FROM playlists WHERE uri = ?", (uri,))
+    return changed
+
+def load_library_index():
+    global library_tracks, library_playlists
+    with spotify_library_lock:
+        db = get_library_db()
+        tracks = [{"uri": uri, "id": track_id, "name": name, "artist": artist, "artist_id": artist_id}
+                  for uri, track_id, name, artist, artist_id in db.execute("SELECT * FROM tracks")]
+        playlists = [{"uri": uri, "id": playlist_id, "name": name}
+                     for uri, playlist_id, name, _ in db.execute("SELECT * FROM playlists")]
+    library_tracks = LibraryIndex(tracks)
+    library_playlists = LibraryIndex(playlists)
+
+def sync_spotify_library():
+    with spotify_library_lock:
+        db = get_library_db()
+        with db:
+            saved = sync_saved_tracks(db)
+            changed = sync_playlists(db)
+    load_library_index()
+    print(f"Spotify library synced: {saved} new liked tracks, {changed} playlists updated.")
+
+def sync_spotify_library_loop():
+    try:
+        load_library_index()
+    except sqlite3.Error as e:
+        print(f"Error loading Spotify library: {e}")
+    while True:
+        try:
+            sync_spotify_library()
+        except Exception as e:
+            print(f"Error syncing Spotify library: {e}")
+        time.sleep(SPOTIFY_LIBRARY_SYNC_INTERVAL)
+
+def find_library_track(track_name, artist_name=""):
+    if not library_tracks:
+        return None
+    return library_tracks.lookup(track_name, artist_name, coverage=SPOTIFY_LIBRARY_TRACK_COVERAGE)
+
+def find_library_playlist(playlist_name, threshold=SPOTIFY_LIBRARY_MATCH_THRESHOLD):
+    return library_playlists.lookup(playlist_name, threshold=threshold) if library_playlists else None
+
+def get_liked_track_uris(limit=SPOTIFY_PLAYBACK_URI_LIMIT):
+    with spotify_library_lock:
+        uris = [row[0] for row in get_library_db().execute(
+            "SELECT uri FROM saved_tracks ORDER BY added_at DESC LIMIT ?", (limit,))]
+    if not uris:
+        results = get_spotify().current_user_saved_tracks(limit=50)
+        uris = [item['track']['uri'] for item in results['items']]
+    return uris
+
+# Spotify Background Jobs
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def block(self, seconds):
+        # Holds every caller back until the server's Retry-After has passed.
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+spotify_rate_bucket = TokenBucket(SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST)
+
+def spotify_call(method, *args, **kwargs):
+    for attempt in range(SPOTIFY_RATE_RETRIES + 1):
+        spotify_rate_bucket.acquire()
+        try:
+            return method(*args, **kwargs)
+        except spotify_exception_type() as e:
+            if e.http_status != 429 or attempt == SPOTIFY_RATE_RETRIES:
+                raise
+            retry_after = (getattr(e, "headers", None) or {}).get("Retry-After")
+            spotify_rate_bucket.block(float(retry_after) if retry_after else 2 ** attempt)
+
+def run_spotify_jobs():
+    while True:
+        job = spotify_jobs.get()
+        try:
+            job()
+        except Exception as e:
+            print(f"Error in Spotify job: {e}")
+
+def submit_spotify_job(job):
+    global spotify_job_worker
+    with spotify_queue_lock:
+        if spotify_job_worker is None or not spotify_job_worker.is_alive():
+            spotify_job_worker = threading.Thread(target=run_spotify_jobs, daemon=True)
+            spotify_job_worker.start()
+    spotify_jobs.put(job)
+
+def remember_playback(track_uri):
+    with spotify_queue_lock:
+        playback_history.append(track_uri)
+
+def get_spotify_queue_progress():
+    with spotify_queue_lock:
+        return dict(spotify_queue_progress)
+
+def queue_spotify_recommendations(device_id, seed_tracks, seed_artists):
+    # Starting another track supersedes a fill that is still running for the previous one.
+    global spotify_queue_generation
+    with spotify_queue_lock:
+        spotify_queue_generation += 1
+        generation = spotify_queue_generation
+        spotify_queue_progress.update(queued=0, total=0, state="pending")
+    submit_spotify_job(lambda: fill_spotify_queue(generation, device_id, seed_tracks, seed_artists))
+
+def fill_spotify_queue(generation, device_id, seed_tracks, seed_artists):
+    def superseded():
+        return generation != spotify_queue_generation
+
+    # add_to_queue fails until Spotify has actually started the new track.
+    time.sleep(SPOTIFY_QUEUE_START_DELAY)
+    if superseded():
+        return
+    try:
+        available_genres = get_spotify_resource("genre_seeds")
+    except Exception:
+        available_genres = ["pop"]
+    seed_genres = [random.choice(available_genres)] if available_genres else ["pop"]
+    try:
+        recommendations = spotify_call(
+            get_spotify().recommendations,
+            seed_tracks=seed_tracks if seed_tracks else None,
+            seed_artists=seed_artists if seed_artists else None,
+            seed_genres=seed_genres,
+            limit=min(100, SPOTIFY_QUEUE_SIZE * 2)
+        )
+        with spotify_queue_lock:
+            skip = set(playback_history) | set(spotify_queued_uris)
+        uris = [uri for uri in dict.fromkeys(track["uri"] for track in recommendations["tracks"]) if uri not in skip]
+        uris = uris[:SPOTIFY_QUEUE_SIZE]
+        with spotify_queue_lock:
+            spotify_queue_progress.update(queued=0, total=len(uris), state="filling")
+        for uri in uris:
+            if superseded():
+                print("Spotify queue fill superseded by a newer track.")
+                return
+            spotify_call(get_spotify().add_to_queue, uri, device_id=device_id)
+            with spotify_queue_lock:
+                spotify_queued_uris.append(uri)
+                spotify_queue_progress["queued"] += 1
+    except Exception:
+        # Leave a failed state behind so progress never reads as pending forever.
+        with spotify_queue_lock:
+            if not superseded():
+                spotify_queue_progress["state"] = "failed"
+        raise
+    with spotify_queue_lock:
+        spotify_queue_progress["state"] = "done"
+    print(f"Queued {len(uris)} recommended tracks on Spotify.")
+
+@traced("spotify")
 def play_track_on_spotify(track_name, artist_name=""):
     try:
-        search_transcript = f"track:{track_name}"
-        if artist_name:
-            search_transcript += f" artist:{artist_name}"
-        results = sp.search(q=search_transcript, type='track', limit=5)
-        items = results.get('tracks', {}).get('items', [])
-        if not items:
-            say(f"I couldn't find {track_name} on Spotify.")
-            return False
-        best_match = next((track for track in items if track['name'].lower() == track_name.lower()), items[0])
-        track_uri = best_match['uri']
-        track_id = best_match['id']  
-        artist_id = best_match['artists'][0]['id']
-        artist_name = best_match['artists'][0]['name']
-        devices_info = sp.devices()
-        devices = devices_info.get('devices', [])
-        if not devices:
+        local_match = find_library_track(track_name, artist_name)
+        if local_match:
+            track_uri = local_match['uri']
+            track_id = local_match['id']
+            artist_id = local_match['artist_id']
+            artist_name = local_match['artist']
+            title = local_match['name']
+        else:
+            search_transcript = f"track:{track_name}"
+            if artist_name:
+                search_transcript += f" artist:{artist_name}"
+            results = get_spotify().search(q=search_transcript, type='track', limit=5)
+            items = results.get('tracks', {}).get('items', [])
+            if not items:
+                say(f"I couldn't find {track_name} on Spotify.")
+                return False
+            best_match = next((track for track in items if track['name'].lower() == track_name.lower()), items[0])
+            track_uri = best_match['uri']
+            track_id = best_match['id']
+            artist_id = best_match['artists'][0]['id']
+            artist_name = best_match['artists'][0]['name']
+            title = best_match['name']
+        device_id = run_on_spotify_device(lambda device_id: get_spotify().start_playback(device_id=device_id, uris=[track_uri]))
+        if device_id is None:
             say("No active Spotify.")
             return False
-        device_id = devices[0]['id']
-        sp.start_playback(device_id=device_id, uris=[track_uri])
-        say(f"Playing {best_match['name']} by {artist_name} on Spotify.")
-        time.sleep(5)
+        say(f"Playing {title} by {artist_name} on Spotify.")
+        remember_playback(track_uri)
         seed_tracks = [track_id] if track_id else []
         seed_artists = [artist_id] if artist_id else []
-        try:
-            available_genres = sp.recommendation_genre_seeds()["genres"]
-        except Exception as e:
-            available_genres = ["pop"] 
-        seed_genres = [random.choice(available_genres)] if available_genres else ["pop"]
-        recommended_uris = []
-        for attempt in range(2):  
-            try:
-                recommendations = sp.recommendations(
-                    seed_tracks=seed_tracks if seed_tracks else None,
-                    seed_artists=seed_artists if seed_artists else None,
-                    seed_genres=seed_genres,
-                    limit=20
-                )
-                recommended_uris = [track["uri"] for track in recommendations["tracks"]]
-                if recommended_uris:
-                    break  
-            except spotipy.exceptions.SpotifyException as e:
-                time.sleep(2)
-        if recommended_uris:
-            for track_uri in recommended_uris:
-                sp.add_to_queue(track_uri, device_id=device_id)
+        queue_spotify_recommendations(device_id, seed_tracks, seed_artists)
         return True
     except Exception as e:
         print(f"Spotify playback error: {e}")
         return False
 
+@traced("spotify")
 def play_spotify_liked_songs():
     try:
-        results = sp.current_user_saved_tracks(limit=50)
-        track_uris = [item['track']['uri'] for item in results['items']]
-        sp.start_playback(uris=track_uris)
+        get_spotify().start_playback(uris=get_liked_track_uris())
         print("Playing liked songs on Spotify")
         return True
     except Exception as e:
         print(f"Error playing liked songs: {e}")
         return False
 
+@traced("spotify")
 def next_track_spotify():
     try:
-        devices_info = sp.devices()
-        devices = devices_info.get('devices', [])
-        if not devices:
+        if run_on_spotify_device(lambda device_id: get_spotify().next_track(device_id=device_id)) is None:
             print("No active device found.")
             say("No active Spotify.")
             return False
-        device_id = devices[0]['id'] 
-        sp.next_track(device_id=device_id)
         print("Skipped to next track on Spotify.")
         return True
     except Exception as e:
         print(f"Error skipping track: {e}")
         say("error.")
         return False
-    
-playback_history = []
 
+@traced("spotify")
 def previous_track_spotify():
     try:
-        devices_info = sp.devices()
-        devices = devices_info.get('devices', [])
-        if not devices:
+        if run_on_spotify_device(lambda device_id: get_spotify().previous_track(device_id=device_id)) is None:
             say("No active Spotify.")
             return False
-        device_id = devices[0]['id']
-        sp.previous_track(device_id=device_id)
         say("Playing the previous track on Spotify.")
         return True
     except Exception as e:
         say("Couldn't go back.")
         return False
 
+@traced("spotify")
 def play_pause_spotify():
     try:
-        current_playback = sp.current_playback()
+        current_playback = get_spotify_resource("playback", fresh=True)
         if current_playback:
             if current_playback["is_playing"]:
-                sp.pause_playback()
+                get_spotify().pause_playback()
             else:
-                sp.start_playback()
+                get_spotify().start_playback()
+            refresh_spotify_resource_async("playback")
             return True
         else:
             say("No active Spotify.")
@@ -451,257 +2659,407 @@ def play_pause_spotify():
         say("Make sure Spotify is active.")
         return False
     
+@traced("spotify")
 def play_spotify_saved_playlist(playlist_name=None, shuffle=False):
     try:
-        devices_info = sp.devices()
-        devices = devices_info.get('devices', [])
-        if not devices:
+        device_id = get_spotify_device_id()
+        if device_id is None:
             say("No active Spotify.")
             return False
-        device_id = devices[0]['id']
         if playlist_name and "liked" in playlist_name.lower():
-            results = sp.current_user_saved_tracks(limit=50)
-            track_uris = [item['track']['uri'] for item in results['items']]
+            track_uris = get_liked_track_uris()
             if not track_uris:
                 say("Your liked songs list is empty.")
                 return False
             if shuffle:
                 random.shuffle(track_uris)
-            sp.shuffle(shuffle, device_id=device_id)
-            sp.start_playback(device_id=device_id, uris=track_uris)
+
+            def start_liked_songs(device_id):
+                get_spotify().shuffle(shuffle, device_id=device_id)
+                get_spotify().start_playback(device_id=device_id, uris=track_uris)
+
+            if run_on_spotify_device(start_liked_songs) is None:
+                say("No active Spotify.")
+                return False
             say(f"Playing your liked songs {'on shuffle' if shuffle else ''}.")
             return True
-        playlists = sp.current_user_playlists(limit=50)['items']
-        matching_playlist = next((p for p in playlists if p['name'].lower() == playlist_name.lower()), None)
+        matching_playlist = find_library_playlist(playlist_name)
+        if not matching_playlist:
+            playlists = get_spotify_resource("playlists")
+            matching_playlist = next((p for p in playlists if p['name'].lower() == playlist_name.lower()), None)
         if not matching_playlist:
             say(f"I couldn't find a playlist named {playlist_name}.")
             return False
         playlist_uri = matching_playlist['uri']
-        sp.shuffle(shuffle, device_id=device_id)
-        sp.start_playback(device_id=device_id, context_uri=playlist_uri)
+
+        def start_playlist(device_id):
+            get_spotify().shuffle(shuffle, device_id=device_id)
+            get_spotify().start_playback(device_id=device_id, context_uri=playlist_uri)
+
+        if run_on_spotify_device(start_playlist) is None:
+            say("No active Spotify.")
+            return False
         say(f"Playing your playlist {playlist_name} {'on shuffle' if shuffle else ''}.")
         return True
     except Exception as e:
         print(f"Error playing playlist: {e}")
         return False
     
-def play_song(transcript):
-    song_transcript = transcript.lower().replace("play", "").strip()
-    if "on youtube" in transcript.lower():
-        song_transcript = song_transcript.replace("on youtube", "").strip()
-        say(f"Playing {song_transcript} on YouTube.")
-        play_on_youtube(song_transcript)
-    elif "on spotify" in transcript.lower():
-        song_transcript = song_transcript.replace("on spotify", "").strip()
-        say(f"Playing {song_transcript} on Spotify.")
-        play_track_on_spotify(song_transcript)
+def play_song(song_name):
+    # Listening starts after the question, so the microphone doesn't pick it up as the answer.
+    say("Where do you want to play it? YouTube or Spotify?", wait=True)
+    if turn_cancelled():
+        return
+    response = takeCommand()
+    if response:
+        response = response.lower()
+        if "youtube" in response:
+            say(f"Playing {song_name} on YouTube.")
+            play_on_youtube(song_name)
+        elif "spotify" in response:
+            say(f"Playing {song_name} on Spotify.")
+            play_track_on_spotify(song_name)
+        else:
+            say("I didn't get that. Please say YouTube or Spotify.")
     else:
-        say("Where do you want to play it? YouTube or Spotify?")
-        response = takeCommand()
-        if response:
-            response = response.lower()
-            if "youtube" in response:
-                say(f"Playing {song_transcript} on YouTube.")
-                play_on_youtube(song_transcript)
-            elif "spotify" in response:
-                say(f"Playing {song_transcript} on Spotify.")
-                play_track_on_spotify(song_transcript)
+        say("I didn't hear your response. Please try again.")
+
+# Intent Router
+
+class Intent:
+    def __init__(self, name, patterns, handler, priority, slot_parser=None):
+        self.name = name
+        self.patterns = patterns
+        self.handler = handler
+        self.priority = priority
+        self.slot_parser = slot_parser
+
+def register_intent(name, patterns, priority=50, slot_parser=None):
+    # Lower priority values win when several intents match the same transcript.
+    def decorator(handler):
+        global intent_matcher
+        intent_registry.append(Intent(name, patterns, handler, priority, slot_parser))
+        intent_matcher = None
+        return handler
+    return decorator
+
+def normalize_transcript(transcript):
+    text = re.sub(r"[^a-z0-9%' ]+", " ", transcript.lower())
+    return " ".join(text.split())
+
+def compile_intents():
+    # Every pattern becomes one alternative of a single regex. Each alternative is anchored at the
+    # start with a lazy prefix, so the first alternative in priority order that matches anywhere wins.
+    global intent_matcher, intent_groups
+    alternatives = []
+    groups = {}
+    ordered = sorted(enumerate(intent_registry), key=lambda item: (item[1].priority, item[0]))
+    for intent_index, intent in ordered:
+        for pattern_index, pattern in enumerate(intent.patterns):
+            group = f"i{intent_index}_{pattern_index}"
+            slot_names = re.findall(r"\(\?P<(\w+)>", pattern)
+            pattern = re.sub(r"\(\?P<(\w+)>", lambda m: f"(?P<{group}__{m.group(1)}>", pattern)
+            alternatives.append(f"(?P<{group}>.*?\\b(?:{pattern}))")
+            groups[group] = (intent, [(f"{group}__{slot}", slot) for slot in slot_names])
+    intent_matcher = re.compile("|".join(alternatives))
+    intent_groups = groups
+
+def match_intent(transcript):
+    if intent_matcher is None:
+        compile_intents()
+    text = normalize_transcript(transcript)
+    match = intent_matcher.match(text)
+    if not match:
+        return None, {"text": text}
+    intent, slot_groups = intent_groups[match.lastgroup]
+    slots = {slot: match.group(group) for group, slot in slot_groups}
+    slots = {slot: value.strip() for slot, value in slots.items() if value is not None}
+    if intent.slot_parser:
+        slots = intent.slot_parser(slots)
+    slots["text"] = text
+    return intent, slots
+
+def dispatch_command(transcript):
+    start = time.time()
+    intent, slots = match_intent(transcript)
+    record_span("intent", start, intent=intent.name if intent else None)
+    if intent is None:
+        say("I didn't catch that, say Grace to wake me up.")
+        return None
+    start = time.time()
+    try:
+        intent.handler(slots)
+    except Exception as e:
+        # An integration that failed to load only costs the command that needed it.
+        print(f"Error handling {intent.name}: {e}")
+        say("Something went wrong.")
+    finally:
+        record_span("dispatch", start, intent=intent.name)
+        if current_turn_start is not None:
+            record_span("turn", current_turn_start, intent=intent.name)
+    return intent.name
+
+def parse_reminder_slots(slots):
+    if "minutes" in slots:
+        slots["minutes"] = int(slots["minutes"])
+    slots.setdefault("reminder", "your reminder")
+    return slots
+
+def parse_volume_slots(slots):
+    volume = slots.get("volume")
+    if volume is not None:
+        slots["volume"] = NUMBER_WORDS[volume] if volume in NUMBER_WORDS else int(volume)
+    return slots
+
+def parse_weather_slots(slots):
+    details = slots.pop("details", "")
+    when = re.search(r"\b(tomorrow|tonight|later)\b", details)
+    # Time words are never part of the place: "weather for tomorrow" keeps the default location.
+    place = " ".join(re.sub(r"\b(?:right now|now|today|tomorrow|tonight|later)\b", " ", details).split())
+    location = re.search(r"\b(?:in|for) ([a-z][a-z ]*?)(?: like)?$", place)
+    if when:
+        slots["when"] = when.group(1)
+    elif slots.get("kind") == "forecast":
+        slots["when"] = "later"
+    if location:
+        slots["location"] = location.group(1)
+    return slots
+
+def parse_shuffle_slots(slots):
+    for slot in ("track", "playlist"):
+        if slot in slots:
+            slots["shuffle"] = bool(re.search(r"\bshuffle\b", slots[slot]))
+            slots[slot] = " ".join(re.sub(r"\b(?:on )?shuffle\b", " ", slots[slot]).split())
+    slots.setdefault("shuffle", False)
+    return slots
+
+# Command Handlers
+
+@register_intent("quit", [r"quit yourself"], priority=10)
+def handle_quit(slots):
+    # The speech worker is a daemon thread, so the goodbye has to finish before the process exits.
+    say("Hope to see you again.", wait=True)
+    if driver is not None:
+        driver.quit()
+    exit()
+
+@register_intent("reset_chat", [r"reset (?:the )?chat"], priority=10)
+def handle_reset_chat(slots):
+    reset_conversation()
+
+@register_intent("clear_answer_cache", [r"clear (?:the )?answer cache"], priority=10)
+def handle_clear_answer_cache(slots):
+    clear_answer_cache()
+    say("Ok.")
+
+@register_intent("chat_size", [r"chat size"], priority=10)
+def handle_chat_size(slots):
+    say(describe_conversation())
+
+@register_intent("api_time", [r"api time"], priority=10)
+def handle_api_time(slots):
+    show_api_usage()
+
+@register_intent("open_youtube_music", [r"open youtube music"], priority=15)
+def handle_open_youtube_music(slots):
+    say("Opening YouTube Music")
+    os.system(r'"C:\Users\LEGION\AppData\Local\Google\Chrome\Application\chrome_proxy.exe" --profile-directory=Default --app-id=cinhimbnkkaeohfgghhklpknlkffjgod')
+
+@register_intent("open_site", [r"open (?P<site>youtube on chrome|wikipedia|google)\b"], priority=20)
+def handle_open_site(slots):
+    say(f"Opening {slots['site']}")
+    webbrowser.open(SITES[slots["site"]])
+
+@register_intent("open_books", [r"open my books"], priority=20)
+def handle_open_books(slots):
+    say("Ok")
+    os.system(r'"C:\Users\LEGION\Downloads\Books"')
+
+@register_intent("reminder", [r"remind me(?: in (?P<minutes>\d+)\s*(?:minutes?|mins?|m\b)?(?: about (?P<reminder>.+))?)?"],
+                 priority=20, slot_parser=parse_reminder_slots)
+def handle_reminder(slots):
+    if "minutes" in slots:
+        add_reminder(slots["reminder"], slots["minutes"])
+    else:
+        say("Please specify a valid time.")
+
+@register_intent("list_reminders", [r"(?:list|what are) (?:my |the )?reminders", r"any reminders"], priority=18)
+def handle_list_reminders(slots):
+    pending = list_reminders()
+    if not pending:
+        say("You have no reminders.")
+        return
+    descriptions = []
+    for reminder_text, trigger_time in pending:
+        minutes = max(0, round((trigger_time - time.time()) / 60))
+        descriptions.append(f"{reminder_text} in {minutes} minutes")
+    say(f"You have {len(pending)} reminders: " + ", ".join(descriptions) + ".")
+
+@register_intent("cancel_reminder", [r"(?:cancel|delete) (?P<all>all )?(?:my |the )?reminders?(?: about (?P<reminder>.+))?"], priority=18)
+def handle_cancel_reminder(slots):
+    if "all" in slots:
+        count = cancel_all_reminders()
+    else:
+        count = cancel_reminders(slots.get("reminder"))
+    if count:
+        say(f"Cancelled {count} reminder{'s' if count > 1 else ''}.")
+    else:
+        say("I couldn't find that reminder.")
+
+@register_intent("youtube_play_pause", [r"(?:pause|resume) youtube"], priority=24)
+def handle_youtube_play_pause(slots):
+    say("Done.")
+    selenium_play_pause()
+
+@register_intent("spotify_play_pause", [r"(?:pause|resume) (?:spotify|songs)\b", r"play spotify$"], priority=24)
+def handle_spotify_play_pause(slots):
+    if play_pause_spotify():
+        say("Done.")
+    else:
+        say("Couldn't toggle Spotify playback.")
+
+@register_intent("youtube_play", [r"play (?:on )?youtube (?P<track>.+)", r"play (?P<track>.+?) (?:on )?youtube\b"], priority=25)
+def handle_youtube_play(slots):
+    say(f"Playing {slots['track']} on YouTube.")
+    play_on_youtube(slots["track"])
+
+@register_intent("spotify_playlist", [r"play (?:my )?playlist (?P<playlist>.+?) on spotify\b"],
+                 priority=25, slot_parser=parse_shuffle_slots)
+def handle_spotify_playlist(slots):
+    if play_spotify_saved_playlist(slots["playlist"], slots["shuffle"]):
+        print(f"Playing your playlist {slots['playlist']}.")
+    else:
+        print(f"Couldn't find your playlist {slots['playlist']}.")
+
+@register_intent("spotify_play", [r"play (?P<track>.+?) on spotify\b"], priority=26, slot_parser=parse_shuffle_slots)
+def handle_spotify_play(slots):
+    track = slots["track"]
+    shuffle = slots["shuffle"]
+    if "my liked songs" in track or track == "liked songs":
+        if not play_spotify_saved_playlist("liked songs", shuffle):
+            print("Couldn't play your liked songs.")
+        return
+    # Only a full match counts here; partial ones are more likely a track title.
+    playlist = find_library_playlist(track, threshold=1.0)
+    if playlist is None:
+        saved_playlists = {p['name'].lower(): p for p in get_spotify_resource("playlists")}
+        playlist = saved_playlists.get(track)
+    if playlist:
+        if not play_spotify_saved_playlist(playlist['name'], shuffle):
+            print(f"Couldn't find your playlist {track}.")
+    elif play_track_on_spotify(track):
+        print(f"Playing {track} on Spotify.")
+    else:
+        print(f"Couldn't find {track} on Spotify.")
+
+@register_intent("the_time", [r"the time\b", r"what time is it"], priority=30)
+def handle_the_time(slots):
+    now = datetime.datetime.now()
+    hour, minute = now.strftime("%H"), now.strftime("%M")
+    say(f"The time is {hour} and {minute} minutes")
+
+@register_intent("volume", [r"volume(?:.*?\b(?P<volume>\d{1,3}|zero|ten|twenty|thirty|forty|fifty|sixty|seventy|eighty|ninety|hundred)\b)?"],
+                 priority=30, slot_parser=parse_volume_slots)
+def handle_volume(slots):
+    volume_percentage = slots.get("volume")
+    if volume_percentage is not None and 0 <= volume_percentage <= 100:
+        set_system_volume(volume_percentage)
+        say("Ok.")
+    else:
+        say("Please specify a valid percentage")
+
+@register_intent("next_track", [r"next (?:song|track|video)\b", r"^skip\b", r"skip (?:this |the )?(?:song|track|video)\b"], priority=30)
+def handle_next_track(slots):
+    try:
+        current_playback = get_spotify_resource("playback")
+        if current_playback:
+            if next_track_spotify():
+                say("next track on Spotify.")
+                if not current_playback["is_playing"]:
+                    time.sleep(1)
+                    try:
+                        get_spotify().start_playback()
+                    except Exception as e:
+                        print(f"Error resuming playback: {e}")
+                        say("I skipped the track, but I couldn't resume playback.")
+            else:
+                say("Couldn't skip track.")
+        else:
+            say("next YouTube video.")
+            selenium_next_video()
+    except Exception as e:
+        print(f"Error detecting playback state: {e}")
+        say("I couldn't determine where to skip. Try again.")
+
+@register_intent("previous_track", [r"previous (?:song|track)\b", r"repeat that song"], priority=30)
+def handle_previous_track(slots):
+    try:
+        current_playback = get_spotify_resource("playback")
+        if current_playback or get_spotify_resource("devices"):
+            if previous_track_spotify():
+                say("Replaying the previous track.")
+                if current_playback and not current_playback["is_playing"]:
+                    time.sleep(1)
+                    try:
+                        get_spotify().start_playback()
+                    except Exception as e:
+                        print(f"Error resuming playback: {e}")
+                        say("I couldn't resume the track, but it has been skipped back.")
             else:
-                say("I didn't get that. Please say YouTube or Spotify.")
+                say("Couldn't go back.")
         else:
-            say("I didn't hear your response. Please try again.")
+            say("Spotify is not open.")
+    except Exception as e:
+        print(f"Error in repeat that song: {e}")
+        say("Something went wrong.")
+
+@register_intent("weather", [r"(?P<kind>weather|forecast)\b(?P<details>.*)"], priority=40, slot_parser=parse_weather_slots)
+def handle_weather(slots):
+    weather_info = get_weather(slots.get("location"), slots.get("when"))
+    say(weather_info)
+
+@register_intent("ask_ai", [r"(?:search for|ask ai|tell me about) (?P<query>.+)"], priority=45)
+def handle_ask_ai(slots):
+    use_cache = not depends_on_context(slots["query"])
+    if GEMINI_STREAMING:
+        speak_gemini_response(slots["query"], use_cache)
+    else:
+        gemini_response = get_gemini_response(slots["query"], use_cache)
+        print(gemini_response)
+        speak_text(gemini_response)
+
+@register_intent("play", [r"play (?P<track>.+)"], priority=50)
+def handle_play(slots):
+    play_song(slots["track"])
+
+@register_intent("nothing", [r"nothing\b"], priority=60)
+def handle_nothing(slots):
+    say("Ok, call if you need any help.")
+
+
+def start_background_services():
+    # Everything that is not needed to hear the wake word waits until the loop is listening.
+    wake_loop_ready.wait()
+    for target in (warm_integrations, refresh_voice_quotas, prewarm_tts_cache, warm_spotify_cache, sync_spotify_library_loop,
+                   monitor_browser, prefetch_weather_loop):
+        threading.Thread(target=target, daemon=True).start()
 
 
 if __name__ == '__main__':
     reminder_thread = threading.Thread(target=check_reminders, daemon=True)
     reminder_thread.start()
+    threading.Thread(target=flush_api_usage_loop, daemon=True).start()
+    threading.Thread(target=start_background_services, daemon=True).start()
     #say("Grace here, what's up?")
     while True:
         if wakeUp():
             start_time = time.time()
             while True:
-                transcript = takeCommand()
+                transcript = takeCommand(early_commit=True)
                 
                 if transcript:
-                    sites = [
-                        ["youtube on chrome", "https://www.youtube.com"],
-                        ["wikipedia", "https://www.wikipedia.com"],
-                        ["google", "https://www.google.com"]
-                    ]
-                    found_site = False
-                    for site in sites:
-                        if f"open {site[0]}".lower() in transcript.lower():
-                            say(f"Opening {site[0]}")
-                            webbrowser.open(site[1])
-                            found_site = True
-                            break
-                    if found_site:
-                        break
-
-                    if "open my books" in transcript.lower():
-                        say("Ok")
-                        os.system(r'"C:\Users\LEGION\Downloads\Books"')
-                        break
-
-                    if "remind me" in transcript.lower():
-                        match = re.search(r'remind me in (\d+)\s*(?:minutes?|mins?|m)?(?: about (.+))?', transcript.lower())
-                        if match:
-                            delay_minutes = int(match.group(1))  # Extract minutes
-                            reminder_text = match.group(2) if match.group(2) else "your reminder"  # Extract text if available
-                            add_reminder(reminder_text, delay_minutes) 
-                        else:
-                            say("Please specify a valid time.")
-                        break
-
-                    elif "the time" in transcript.lower():
-                        now = datetime.datetime.now()
-                        hour, minute = now.strftime("%H"), now.strftime("%M")
-                        say(f"The time is {hour} and {minute} minutes")
-                        break
-
-                    elif "open youtube music" in transcript.lower():
-                        say("Opening YouTube Music")
-                        os.system(r'"C:\Users\LEGION\AppData\Local\Google\Chrome\Application\chrome_proxy.exe" --profile-directory=Default --app-id=cinhimbnkkaeohfgghhklpknlkffjgod')
-                        break
-
-                    elif "play" in transcript.lower() and ("on youtube" in transcript.lower() or "youtube" in transcript.lower()):
-                        music_transcript = transcript.lower().replace("play", "").replace("on youtube", "").replace("youtube", "").strip()
-                        if music_transcript:
-                            say(f"Playing {music_transcript} on YouTube.")
-                            play_on_youtube(music_transcript)
-                        else:
-                            say("Please specify what to play.")
-                        break
-
-                    elif process_volume_command(transcript):
-                        say("Ok.")
-                        break
-
-                    elif "pause youtube" in transcript.lower() or "resume youtube" in transcript.lower():
-                        say("Done.")
-                        selenium_play_pause()
-                        break
-
-                    elif "play" in transcript.lower() and "on spotify" in transcript.lower():
-                        track_or_playlist_transcript = transcript.lower().replace("play", "").replace("on spotify", "").strip()
-                        shuffle = "shuffle" in track_or_playlist_transcript  
-                        track_or_playlist_transcript = track_or_playlist_transcript.replace("shuffle", "").strip()
-                        user_playlists = sp.current_user_playlists(limit=50)['items']
-                        saved_playlist_names = {p['name'].lower(): p['uri'] for p in user_playlists}
-                        if "my liked songs" in track_or_playlist_transcript:
-                            if play_spotify_saved_playlist("liked songs", shuffle):
-                                say("Playing your liked songs on shuffle." if shuffle else "Playing your liked songs.")
-                            else:
-                                print("Couldn't play your liked songs.")
-                        elif track_or_playlist_transcript in saved_playlist_names: 
-                            playlist_uri = saved_playlist_names[track_or_playlist_transcript]
-                            if play_spotify_saved_playlist(playlist_uri, shuffle):
-                                say(f"Playing your playlist {track_or_playlist_transcript} on shuffle." if shuffle else f"Playing your playlist {track_or_playlist_transcript}.")
-                            else:
-                                print(f"Couldn't find your playlist {track_or_playlist_transcript}.")
-                        else:  
-                            if play_track_on_spotify(track_or_playlist_transcript):
-                                print(f"Playing {track_or_playlist_transcript} on Spotify.")
-                            else:
-                                print(f"Couldn't find {track_or_playlist_transcript} on Spotify.")
-                        break
-
-                    elif "next song" in transcript.lower() or "skip" in transcript.lower():
-                        try:
-                            current_playback = sp.current_playback()
-
-                            if current_playback: 
-                                if next_track_spotify():
-                                    say("next track on Spotify.")
-                                    if not current_playback["is_playing"]:
-                                        time.sleep(1) 
-                                        try:
-                                            sp.start_playback()
-                                        except Exception as e:
-                                            print(f"Error resuming playback: {e}")
-                                            say("I skipped the track, but I couldn't resume playback.")
-                                else:
-                                    say("Couldn't skip track.")
-                            else:
-                                say("next YouTube video.")
-                                selenium_next_video()
-                        except Exception as e:
-                            print(f"Error detecting playback state: {e}")
-                            say("I couldn't determine where to skip. Try again.")
-                        break
-
-                    elif "previous track" in transcript.lower() or "repeat that song" in transcript.lower():
-                        try:
-                            current_playback = sp.current_playback()
-                            devices_info = sp.devices()
-                            devices = devices_info.get('devices', [])
-
-                            if current_playback or devices:
-                                if previous_track_spotify():
-                                    say("Replaying the previous track.")
-                                    time.sleep(1)  
-                                    updated_playback = sp.current_playback()
-                                    if updated_playback and not updated_playback["is_playing"]:
-                                        try:
-                                            sp.start_playback()
-                                        except Exception as e:
-                                            print(f"Error resuming playback: {e}")
-                                            say("I couldn't resume the track, but it has been skipped back.")
-                                else:
-                                    say("Couldn't go back.")
-                            else:
-                                say("Spotify is not open.")
-                        except Exception as e:
-                            print(f"Error in repeat that song: {e}")
-                            say("Something went wrong.")
-                        break
-
-                    elif "play" in transcript.lower():
-                        play_song(transcript)
-                        break
-
-                    elif "pause spotify" in transcript.lower() or "play spotify" in transcript.lower() or "pause songs" in transcript.lower() or "resume songs" in transcript.lower():
-                        if play_pause_spotify():
-                            say("Done.")
-                        else:
-                            say("Couldn't toggle Spotify playback.")
-                        break
-
-                    elif "weather" in transcript.lower() or "weather now" in transcript.lower():
-                        weather_info = get_weather() 
-                        say(weather_info)
-                        break
-
-                    elif "api time" in transcript.lower():
-                        show_api_usage()
-                        break
-
-                    elif "quit yourself" in transcript.lower():
-                        say("Hope to see you again.")
-                        driver.quit()
-                        exit()
-
-                    elif "reset chat" in transcript.lower():
-                        say("Chat history reset.")
-                        break
-
-                    elif "nothing" in transcript.lower():
-                        say("Ok, call if you need any help.")
-                        break
-
-                    elif any(trigger in transcript.lower() for trigger in ["search for", "ask ai", "tell me about"]):
-                        for trigger in ["search for", "ask ai", "tell me about"]:
-                            if trigger in transcript.lower():
-                                search_transcript = transcript.lower().split(trigger, 1)[1].strip()
-                                break
-                        gemini_response = get_gemini_response(search_transcript)
-                        print(gemini_response)
-                        say(gemini_response)
-                        break
-
-                    else:
-                     say("I didn't catch that, say Grace to wake me up.")
-                     break  
+                    threading.Thread(target=run_turn, args=(transcript,), daemon=True).start()
+                    break
 
                 elif time.time() - start_time > 5:
                     say("I didn't catch that")
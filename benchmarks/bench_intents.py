@@ -0,0 +1,61 @@
+# Micro-benchmark of intent dispatch latency over the recorded transcripts in transcripts.tsv.
+# Usage: python benchmarks/bench_intents.py [iterations]
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Assistant
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts.tsv")
+
+
+def load_corpus():
+    corpus = []
+    with open(CORPUS_FILE, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip() and not line.startswith("#"):
+                fields = line.rstrip("\n").split("\t")
+                slots = dict(pair.split("=", 1) for pair in fields[2].split(";")) if len(fields) > 2 else {}
+                corpus.append((fields[0], fields[1], slots))
+    return corpus
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    corpus = load_corpus()
+
+    start = time.perf_counter()
+    Assistant.compile_intents()
+    compile_time = time.perf_counter() - start
+
+    mismatches = []
+    for expected, transcript, expected_slots in corpus:
+        intent, slots = Assistant.match_intent(transcript)
+        name = intent.name if intent else "-"
+        if name != expected:
+            mismatches.append((transcript, expected, name))
+        for slot, value in expected_slots.items():
+            if str(slots.get(slot, "")) != value:
+                mismatches.append((transcript, f"{slot}={value!r}", f"{slot}={slots.get(slot)!r}"))
+
+    samples = []
+    for _ in range(iterations):
+        for _, transcript, _ in corpus:
+            start = time.perf_counter()
+            Assistant.match_intent(transcript)
+            samples.append((time.perf_counter() - start) * 1e6)
+
+    print(f"intents: {len(Assistant.intent_registry)}  transcripts: {len(corpus)}  compile: {compile_time * 1e3:.2f} ms")
+    print(f"dispatch latency (us): mean {statistics.mean(samples):.1f}  p50 {percentile(samples, 0.5):.1f}  "
+          f"p95 {percentile(samples, 0.95):.1f}  p99 {percentile(samples, 0.99):.1f}  max {max(samples):.1f}")
+    print(f"throughput: {len(samples) / (sum(samples) / 1e6):.0f} dispatches/s")
+    for transcript, expected, name in mismatches:
+        print(f"MISMATCH: {transcript!r} expected {expected}, got {name}")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,56 @@
+# Checks and times the streamed markdown -> speech text path used for Gemini answers.
+# Each sample is fed to SpeechTextStream in fragments of several sizes; every split has to give the
+# expected sentences, the same as feeding the whole answer at once.
+# Usage: python benchmarks/bench_speech_text.py [iterations]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Assistant
+
+FRAGMENT_SIZES = [1, 7, 64, None]
+SAMPLES = [
+    ("Here are the steps:\n\n1. Install Python. It is free.\n2. Write **code** like this:\n"
+     "```python\nx = 1.\ny = 2.\n```\n3. Run it.\n\nThat's all",
+     ["Here are the steps: Install Python.", "It is free.", "Write code like this: Run it.", "That's all."]),
+    ("## Overview\nPython is *great* for scripting & automation -> see [the docs](https://python.org). "
+     "It runs everywhere.\n\n- Easy to learn\n- Huge ecosystem\n\n| Name | Year |\n|---|---|\n| Python | 1991 |",
+     ["Overview.", "Python is great for scripting and automation to see the docs.", "It runs everywhere.",
+      "Easy to learn.", "Huge ecosystem.", "Name, Year.", "Python, 1991."]),
+    ("2 * 3 = 6; C# is nice; 5 > 3.",
+     ["2 times 3 = 6; C sharp is nice; 5 greater than 3."]),
+    ("Sure! The answer is 42. No markdown here.",
+     ["Sure!", "The answer is 42.", "No markdown here."]),
+]
+
+
+def speak(answer, size):
+    text_stream = Assistant.SpeechTextStream()
+    sentences = []
+    step = size or len(answer)
+    for offset in range(0, len(answer), step):
+        sentences.extend(text_stream.feed(answer[offset:offset + step]))
+    return sentences + text_stream.finish()
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    mismatches = []
+    for answer, expected in SAMPLES:
+        for size in FRAGMENT_SIZES:
+            sentences = speak(answer, size)
+            if sentences != expected:
+                mismatches.append((answer, size, expected, sentences))
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for answer, _ in SAMPLES:
+            speak(answer, 7)
+    elapsed = time.perf_counter() - start
+
+    print(f"samples: {len(SAMPLES)}  fragment sizes: {FRAGMENT_SIZES}")
+    print(f"cleaning in 7-character fragments: {elapsed / (iterations * len(SAMPLES)) * 1e6:.1f} us per answer")
+    for answer, size, expected, sentences in mismatches:
+        print(f"MISMATCH ({size or 'whole'}-character fragments): {answer[:40]!r}\n  expected {expected}\n  got      {sentences}")
+    sys.exit(1 if mismatches else 0)
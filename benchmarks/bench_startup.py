@@ -0,0 +1,86 @@
+# Startup benchmark: import cost per top-level module and cold-start time to a listening wake-word loop.
+# Usage: python benchmarks/bench_startup.py [runs] [--no-wake]
+import os
+import re
+import sys
+import time
+import subprocess
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_LINE = "Listening for wake word..."
+READY_TIMEOUT = 60
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure_imports():
+    # -X importtime lists children before their parent, indented two spaces per level. The modules
+    # Assistant imports directly are the level-two lines right before its own top-level line.
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import Assistant"],
+                            cwd=ROOT, capture_output=True, text=True)
+    direct = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative_us, indent, name = match.groups()
+        if len(indent) == 3:
+            direct[name] = int(cumulative_us) / 1e3
+        elif len(indent) == 1:
+            if name == "Assistant":
+                return int(cumulative_us) / 1e3, direct, None
+            direct = {}
+    return None, {}, result.stderr
+
+
+def measure_cold_start():
+    # Wall time from launching the process to the wake-word loop announcing it is listening.
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-u", "Assistant.py"], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    output = []
+    try:
+        while time.perf_counter() - start < READY_TIMEOUT:
+            line = process.stdout.readline()
+            if not line:
+                break
+            output.append(line)
+            if READY_LINE in line:
+                return time.perf_counter() - start, output
+        return None, output
+    finally:
+        process.kill()
+        process.wait()
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 5
+    totals = []
+    samples = []
+    for _ in range(runs):
+        total, modules, error = measure_imports()
+        if total is None:
+            print(error.splitlines()[-1] if error else "import Assistant failed")
+            sys.exit(1)
+        totals.append(total)
+        samples.append(modules)
+
+    print(f"import Assistant (ms): median {statistics.median(totals):.1f}  min {min(totals):.1f}  "
+          f"max {max(totals):.1f}  over {runs} runs")
+    costs = sorted(((statistics.median(modules.get(name, 0) for modules in samples), name) for name in samples[0]),
+                   reverse=True)
+    for cost, name in costs[:15]:
+        print(f"  {name:<40} {cost:8.1f} ms")
+
+    if "--no-wake" in sys.argv:
+        sys.exit(0)
+    ready = []
+    for _ in range(runs):
+        elapsed, output = measure_cold_start()
+        if elapsed is None:
+            print("Wake-word loop never became ready:")
+            print("".join(output[-10:]).rstrip())
+            sys.exit(1)
+        ready.append(elapsed * 1e3)
+    print(f"cold start to wake loop (ms): median {statistics.median(ready):.1f}  min {min(ready):.1f}  "
+          f"max {max(ready):.1f}  over {runs} runs")
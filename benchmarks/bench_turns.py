@@ -0,0 +1,279 @@
+# End-to-end voice-turn benchmark against local stand-ins for every outbound service.
+# Fixtures from turns.tsv are fed through the real takeCommand -> dispatch_command -> say path with the
+# microphone, speech-to-text, browser and speaker replaced by stubs.
+# Usage: python benchmarks/bench_turns.py [--rounds N] [--realtime] [--no-early-commit] [--set gemini.latency=0.8]
+#        [--update-baseline]
+import os
+import sys
+import time
+import wave
+import queue
+import random
+import argparse
+import tempfile
+import threading
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+from mock_services import MockServices
+
+FIXTURES_FILE = os.path.join(BENCH_DIR, "turns.tsv")
+BASELINE_FILE = os.path.join(BENCH_DIR, "turn_baselines.json")
+STT_LATENCY = 0.3
+SPEECH_SECONDS_PER_WORD = 0.35
+SPEECH_AMPLITUDE = 3000
+SILENCE_AMPLITUDE = 40
+LEADING_SILENCE_SECONDS = 0.5
+TRAILING_SILENCE_SECONDS = 1.5
+SPEECH_END = object()
+
+
+def load_fixtures():
+    fixtures = []
+    with open(FIXTURES_FILE, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip() and not line.startswith("#"):
+                fields = line.rstrip("\n").split("\t")
+                wav = os.path.join(BENCH_DIR, fields[2]) if len(fields) > 2 and fields[2] else None
+                fixtures.append((fields[0], fields[1], wav))
+    return fixtures
+
+
+def parse_overrides(values):
+    config = {}
+    for value in values:
+        key, _, setting = value.partition("=")
+        service, _, name = key.partition(".")
+        config.setdefault(service, {})[name] = float(setting)
+    return config
+
+
+def load_assistant(services, workdir):
+    # Assistant reads its keys at import and keeps its state files in the working directory.
+    for name in ["GEMINI_API_KEY", "WEATHER_API_KEY", "VOICE_API_KEY_1", "VOICE_API_KEY_2", "VOICE_API_KEY_3"]:
+        os.environ[name] = f"bench-{name.lower()}"
+    os.environ["YOUTUBE_BASE_URL"] = f"{services.url}/youtube"
+    os.chdir(workdir)
+    import Assistant
+    import spotipy
+    Assistant.ELEVENLABS_API_URL = f"{services.url}/elevenlabs"
+    Assistant.GEMINI_API_URL = f"{services.url}/gemini"
+    Assistant.OPENWEATHER_API_URL = f"{services.url}/openweather"
+    Assistant.YOUTUBE_URL = f"{services.url}/youtube"
+    Assistant.sp = spotipy.Spotify(auth="bench")
+    Assistant.sp.prefix = f"{services.url}/spotify/v1/"
+    return Assistant
+
+
+class StubDriver:
+    title = "bench"
+
+    def get(self, url):
+        self.url = url
+
+    def execute_script(self, script):
+        return False
+
+    def execute_cdp_cmd(self, command, params):
+        return {}
+
+    def quit(self):
+        pass
+
+
+class Microphone:
+    # Replaces the capture thread: frames queued by the benchmark are written into the shared ring buffer.
+    def __init__(self, Assistant, realtime):
+        self.Assistant = Assistant
+        self.realtime = realtime
+        self.frames = queue.Queue()
+        self.fed = threading.Event()
+        self.spoken = None
+
+    def capture(self):
+        frame_seconds = self.Assistant.CAPTURE_FRAME_LENGTH / self.Assistant.CAPTURE_SAMPLE_RATE
+        while self.Assistant.capture_running:
+            frame = self.frames.get()
+            if frame is None:
+                self.fed.set()
+                continue
+            if frame is SPEECH_END:
+                self.spoken = time.time()
+                continue
+            self.Assistant.capture_ring.write(frame)
+            if self.realtime:
+                time.sleep(frame_seconds)
+
+    def speak(self, transcript, wav=None):
+        np = self.Assistant.np
+        length = self.Assistant.CAPTURE_FRAME_LENGTH
+        rate = self.Assistant.CAPTURE_SAMPLE_RATE
+
+        def noise(seconds, amplitude):
+            return (np.random.standard_normal(int(seconds * rate)) * amplitude).astype(np.int16)
+
+        if wav:
+            with wave.open(wav, "rb") as file:
+                speech = np.frombuffer(file.readframes(file.getnframes()), dtype=np.int16)
+        else:
+            speech = noise(len(transcript.split()) * SPEECH_SECONDS_PER_WORD, SPEECH_AMPLITUDE)
+        leading = noise(LEADING_SILENCE_SECONDS, SILENCE_AMPLITUDE)
+        samples = np.concatenate([leading, speech, noise(TRAILING_SILENCE_SECONDS, SILENCE_AMPLITUDE)])
+        samples = samples[:len(samples) - len(samples) % length]
+        speech_end = -(-(len(leading) + len(speech)) // length)
+        self.fed.clear()
+        self.spoken = None
+        for index, frame in enumerate(samples.reshape(-1, length)):
+            if index == speech_end:
+                self.frames.put(SPEECH_END)
+            self.frames.put(frame)
+        self.frames.put(None)
+
+
+def wait_for_speech(Assistant, timeout=30):
+    # Done once nothing is queued or playing on two checks in a row.
+    deadline = time.time() + timeout
+    idle = 0
+    while idle < 2 and time.time() < deadline:
+        idle = idle + 1 if Assistant.speech_queue.empty() and Assistant.current_utterance is None else 0
+        time.sleep(0.02)
+
+
+def run_turns(Assistant, fixtures, rounds, realtime, early_commit=True):
+    spans = []
+    record_span = Assistant.record_span
+
+    def capture_span(stage, start, end=None, turn=None, **attrs):
+        end = time.time() if end is None else end
+        spans.append((turn or Assistant.current_turn, stage, (end - start) * 1000))
+        record_span(stage, start, end, turn, **attrs)
+
+    played = []
+
+    def play_audio(pcm_chunks, sample_rate=Assistant.TTS_SAMPLE_RATE, cancelled=None):
+        # Consumes the line like the speaker would, noting when its first chunk arrived.
+        played_bytes = 0
+        for pcm in pcm_chunks:
+            if not played_bytes:
+                played.append(time.time())
+            played_bytes += len(pcm)
+        return played_bytes / (sample_rate * 2)
+
+    microphone = Microphone(Assistant, realtime)
+    # Stands in for the speech-to-text service: partials keep pace with the synthetic speech and the
+    # final transcript arrives STT_LATENCY after the endpoint.
+    recognizer = Assistant.FakeRecognizerBackend(frames_per_word=Assistant.frames_for(SPEECH_SECONDS_PER_WORD),
+                                                 latency=STT_LATENCY)
+    Assistant.record_span = capture_span
+    Assistant.play_audio = play_audio
+    Assistant.capture_audio = microphone.capture
+    Assistant.launch_driver = StubDriver
+    Assistant.recognizer_backend = recognizer
+    Assistant.load_module("speech_recognition")
+
+    turns = []
+    mismatches = []
+    started = time.time()
+    for _ in range(rounds):
+        for expected, transcript, wav in fixtures:
+            ring = Assistant.start_capture_engine()
+            Assistant.start_turn()
+            Assistant.command_cursor = ring.latest()
+            recognizer.transcript = transcript
+            del played[:]
+            # Listening starts with the first frame, as in the live loop, so an early commit can
+            # overtake the endpoint; latencies are measured from the end of speech.
+            microphone.speak(transcript, wav)
+            heard = Assistant.takeCommand(early_commit=early_commit)
+            name = Assistant.dispatch_command(heard) if heard else None
+            wait_for_speech(Assistant)
+            microphone.fed.wait()
+            spoken = microphone.spoken
+            if name != expected:
+                mismatches.append((transcript, expected, name))
+            first_audio = (played[0] - spoken) * 1000 if played else None
+            turns.append({"first_audio": first_audio, "turn_total": (time.time() - spoken) * 1000})
+    elapsed = time.time() - started
+    Assistant.record_span = record_span
+    return turns, spans, mismatches, elapsed
+
+
+def summarize(Assistant, turns, spans, elapsed):
+    metrics = {"throughput_turns_per_s": len(turns) / elapsed}
+    for key in ["first_audio", "turn_total"]:
+        samples = [turn[key] for turn in turns if turn[key] is not None]
+        if samples:
+            metrics[f"{key}_p50_ms"] = Assistant.percentile(samples, 0.5)
+            metrics[f"{key}_p95_ms"] = Assistant.percentile(samples, 0.95)
+    by_stage = {}
+    for _, stage, ms in spans:
+        by_stage.setdefault(stage, []).append(ms)
+    return metrics, by_stage
+
+
+def compare(metrics, baseline, tolerance):
+    # Latencies regress when they grow past the tolerance, throughput when it shrinks past it.
+    regressions = []
+    for key, expected in baseline.items():
+        if key not in metrics:
+            continue
+        if key.startswith("throughput"):
+            if metrics[key] < expected * (1 - tolerance):
+                regressions.append((key, expected, metrics[key]))
+        elif metrics[key] > expected * (1 + tolerance):
+            regressions.append((key, expected, metrics[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    import json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--realtime", action="store_true", help="feed fixture audio at capture speed")
+    parser.add_argument("--no-early-commit", action="store_true", help="always wait for the final transcript")
+    parser.add_argument("--set", action="append", default=[], metavar="SERVICE.SETTING=VALUE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    services = MockServices(parse_overrides(args.set)).start()
+    Assistant = load_assistant(services, tempfile.mkdtemp(prefix="bench_turns_"))
+    Assistant.np.random.seed(args.seed)
+    turns, spans, mismatches, elapsed = run_turns(Assistant, load_fixtures(), args.rounds, args.realtime,
+                                                not args.no_early_commit)
+    services.stop()
+    metrics, by_stage = summarize(Assistant, turns, spans, elapsed)
+
+    print(f"turns: {len(turns)}  wall: {elapsed:.2f} s  throughput: {metrics['throughput_turns_per_s']:.2f} turns/s")
+    for key in ["first_audio", "turn_total"]:
+        if f"{key}_p50_ms" in metrics:
+            print(f"{key} (ms): p50 {metrics[f'{key}_p50_ms']:.0f}  p95 {metrics[f'{key}_p95_ms']:.0f}")
+    for stage in Assistant.TRACE_STAGES + sorted(set(by_stage) - set(Assistant.TRACE_STAGES)):
+        if stage in by_stage:
+            samples = by_stage[stage]
+            p50, p95, p99 = (Assistant.percentile(samples, fraction) for fraction in (0.5, 0.95, 0.99))
+            print(f"  {stage:<20} p50 {p50:8.1f}  p95 {p95:8.1f}  p99 {p99:8.1f} ms  ({len(samples)} spans)")
+    print("requests: " + "  ".join(f"{service} {count} ({services.errors[service]} errors)"
+                                   for service, count in services.requests.items()))
+    for transcript, expected, name in mismatches:
+        print(f"MISMATCH: {transcript!r} expected {expected}, got {name}")
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w") as file:
+            json.dump({key: round(value, 2) for key, value in metrics.items()}, file, indent=2)
+        print(f"Baseline written to {BASELINE_FILE}")
+        sys.exit(0)
+    if not os.path.exists(BASELINE_FILE):
+        # Without a baseline nothing is checked, which must not pass as a clean run.
+        print("No baseline stored yet; run with --update-baseline to record one.")
+        sys.exit(2)
+    with open(BASELINE_FILE, "r") as file:
+        regressions = compare(metrics, json.load(file), args.tolerance)
+    for key, expected, actual in regressions:
+        print(f"REGRESSION: {key} {actual:.2f} vs baseline {expected:.2f}")
+    sys.exit(1 if regressions or mismatches else 0)
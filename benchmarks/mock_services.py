@@ -0,0 +1,200 @@
+# Local stand-ins for ElevenLabs, Gemini, OpenWeather, Spotify and YouTube with configurable latency,
+# chunking and error injection. All services share one server and are told apart by their path prefix.
+import json
+import math
+import array
+import random
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# latency: seconds before the first byte; chunk_delay: seconds between streamed chunks;
+# error_rate: share of requests answered with error_status instead.
+SERVICE_DEFAULTS = {
+    "elevenlabs": {"latency": 0.25, "chunk_size": 4096, "chunk_delay": 0.02, "error_rate": 0.0, "error_status": 500},
+    "gemini": {"latency": 0.4, "chunk_delay": 0.08, "error_rate": 0.0, "error_status": 500},
+    "openweather": {"latency": 0.1, "error_rate": 0.0, "error_status": 500},
+    "spotify": {"latency": 0.08, "error_rate": 0.0, "error_status": 429},
+    "youtube": {"latency": 0.2, "error_rate": 0.0, "error_status": 500},
+}
+GEMINI_ANSWER = ("Black holes are regions where gravity is so strong that nothing escapes. "
+                 "They form when massive stars collapse at the end of their lives. "
+                 "The boundary around one is called the event horizon.")
+SPEECH_SECONDS_PER_CHAR = 0.06
+
+
+def make_track(index, name=None):
+    return {"id": f"track{index}", "uri": f"spotify:track:track{index}", "name": name or f"Bench Track {index}",
+            "artists": [{"id": f"artist{index % 7}", "name": f"Bench Artist {index % 7}"}]}
+
+
+class MockServices:
+    def __init__(self, config=None):
+        self.config = {service: dict(settings) for service, settings in SERVICE_DEFAULTS.items()}
+        for service, settings in (config or {}).items():
+            self.config[service].update(settings)
+        self.requests = {service: 0 for service in self.config}
+        self.errors = {service: 0 for service in self.config}
+        self.lock = threading.Lock()
+        self.audio = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def speech_audio(self, text, output_format):
+        # A sine tone as long as the text would take to say, rendered once per length and format.
+        seconds = round(max(0.5, len(text) * SPEECH_SECONDS_PER_CHAR), 1)
+        encoding, rate = output_format.split("_")[:2]
+        with self.lock:
+            if (seconds, output_format) not in self.audio:
+                if encoding == "pcm":
+                    samples = array.array("h", (int(8000 * math.sin(2 * math.pi * 440 * i / int(rate)))
+                                                for i in range(int(seconds * int(rate)))))
+                    audio = samples.tobytes()
+                else:
+                    audio = subprocess.run(
+                        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i",
+                         f"sine=frequency=440:duration={seconds}", "-ac", "1", "-ar", rate, "-f", "mp3", "pipe:1"],
+                        check=True, capture_output=True).stdout
+                self.audio[(seconds, output_format)] = audio
+            return self.audio[(seconds, output_format)]
+
+    def handler_class(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.route("GET")
+
+            def do_POST(self):
+                self.route("POST")
+
+            def do_PUT(self):
+                self.route("PUT")
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def route(self, method):
+                parsed = urlparse(self.path)
+                service, _, path = parsed.path.lstrip("/").partition("/")
+                if service not in services.config:
+                    return self.reply(404, {"error": "unknown service"})
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                settings = services.config[service]
+                with services.lock:
+                    services.requests[service] += 1
+                time.sleep(settings["latency"])
+                if random.random() < settings["error_rate"]:
+                    with services.lock:
+                        services.errors[service] += 1
+                    return self.reply(settings["error_status"], {"error": "injected"}, {"Retry-After": "1"})
+                getattr(self, f"serve_{service}")(method, "/" + path, parse_qs(parsed.query), body, settings)
+
+            def reply(self, status, payload=None, headers=None, content_type="application/json"):
+                data = b"" if payload is None else (payload if isinstance(payload, bytes) else json.dumps(payload).encode())
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream(self, chunks, content_type, delay):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def serve_elevenlabs(self, method, path, query, body, settings):
+                output_format = query.get("output_format", ["mp3_44100_128"])[0]
+                audio = services.speech_audio(json.loads(body or b"{}").get("text", ""), output_format)
+                size = int(settings["chunk_size"])
+                self.stream([audio[i:i + size] for i in range(0, len(audio), size)],
+                            "audio/pcm" if output_format.startswith("pcm") else "audio/mpeg", settings["chunk_delay"])
+
+            def serve_gemini(self, method, path, query, body, settings):
+                if path.endswith(":streamGenerateContent"):
+                    words = GEMINI_ANSWER.split(" ")
+                    fragments = [" ".join(words[i:i + 4]) + " " for i in range(0, len(words), 4)]
+                    events = [b"data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}}]}).encode()
+                              + b"\r\n\r\n" for text in fragments]
+                    return self.stream(events, "text/event-stream", settings["chunk_delay"])
+                self.reply(200, {"candidates": [{"content": {"parts": [{"text": GEMINI_ANSWER}]}}]})
+
+            def serve_openweather(self, method, path, query, body, settings):
+                city = query.get("q", ["Pune"])[0]
+                if path.endswith("/forecast"):
+                    now = int(time.time())
+                    entries = [{"dt": now + i * 10800, "weather": [{"description": "light rain"}],
+                                "main": {"temp_min": 21 + i % 4, "temp_max": 27 + i % 5}} for i in range(16)]
+                    return self.reply(200, {"city": {"name": city, "timezone": 19800}, "list": entries})
+                self.reply(200, {"name": city, "weather": [{"description": "clear sky"}], "main": {"temp": 27.5}})
+
+            def serve_youtube(self, method, path, query, body, settings):
+                page = ('<html><script>var ytInitialData = {"contents":[{"videoRenderer":{"videoId":"dQw4w9WgXcQ"}}]};'
+                        '</script><a id="video-title" href="/watch?v=dQw4w9WgXcQ">result</a></html>')
+                self.reply(200, page.encode(), content_type="text/html")
+
+            def serve_spotify(self, method, path, query, body, settings):
+                if method != "GET":
+                    return self.reply(204)
+                if path == "/v1/me/player":
+                    return self.reply(200, {"is_playing": True, "item": make_track(0), "device": {"id": "bench"}})
+                if path == "/v1/me/player/devices":
+                    return self.reply(200, {"devices": [{"id": "bench", "name": "Bench", "is_active": True}]})
+                if path == "/v1/me/playlists":
+                    return self.reply(200, {"items": [{"id": "mix", "uri": "spotify:playlist:mix", "name": "Bench Mix",
+                                                       "snapshot_id": "1"}], "next": None})
+                if path == "/v1/recommendations/available-genre-seeds":
+                    return self.reply(200, {"genres": ["pop", "rock", "jazz"]})
+                if path == "/v1/recommendations":
+                    return self.reply(200, {"tracks": [make_track(i) for i in range(1, 41)]})
+                if path == "/v1/search":
+                    name = query.get("q", [""])[0].split("track:")[-1].split(" artist:")[0]
+                    return self.reply(200, {"tracks": {"items": [make_track(100, name.title())]}})
+                if path == "/v1/me/tracks":
+                    items = [{"added_at": f"2024-01-{i + 1:02d}T00:00:00Z", "track": make_track(200 + i)} for i in range(20)]
+                    return self.reply(200, {"items": items, "total": len(items), "next": None})
+                if path.startswith("/v1/playlists/"):
+                    return self.reply(200, {"items": [{"track": make_track(300 + i)} for i in range(10)], "next": None})
+                self.reply(404, {"error": {"status": 404, "message": "not mocked"}})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    services = MockServices().start()
+    print(f"Mock services listening on {services.url}")
+    try:
+        services.thread.join()
+    except KeyboardInterrupt:
+        services.stop()